@@ -0,0 +1,228 @@
+"""Benchmark the stages of the gaps pipeline on seeded synthetic data (see synthetic_data.py). Each stage is timed and its
+peak memory recorded, and the results are saved as a json so runs can be compared over time (see compare_results)
+Run from the root of the repository:
+python -m benchmarks.run_benchmarks --scale small
+python -m benchmarks.run_benchmarks --code-dir ../gaps_baseline --out benchmarks/results/small_baseline.json
+python -m benchmarks.run_benchmarks --compare benchmarks/results/old.json benchmarks/results/new.json
+--code-dir benchmarks the pipeline code of another checkout (e.g. a git worktree of an older commit) with this harness"""
+from benchmarks.synthetic_data import ensure_corpus
+from datetime import datetime
+import importlib
+import inspect
+import platform
+import subprocess
+import tracemalloc
+import argparse
+import shutil
+import time
+import copy
+import json
+import sys
+import os
+import pandas as pd
+import numpy as np
+try:
+    import resource
+except ImportError:
+    # Not available on Windows - the peak rss is not recorded
+    resource = None
+
+# Parameters of synthetic_data.generate_corpus for each scale
+SCALES = {
+    "small": {"n_books": 12, "n_ms": 40, "words_per_ms": 300, "n_chains": 150},
+    "medium": {"n_books": 40, "n_ms": 120, "words_per_ms": 300, "n_chains": 1500},
+    "large": {"n_books": 120, "n_ms": 300, "words_per_ms": 300, "n_chains": 10000}
+}
+
+def load_pipeline(code_dir=None):
+    """Import the pipeline modules to benchmark - from code_dir if given (the root of another checkout of the repository),
+    otherwise from this one
+    Returns: dict of module name to module"""
+    if code_dir is not None:
+        sys.path.insert(0, os.path.abspath(code_dir))
+    return {name: importlib.import_module(name) for name in ["utilities.load_all_cls", "utilities.clusterDf",
+                                                             "utilities.data_parsing", "find_shared_gaps.find_shared_gaps"]}
+
+def accepted_kwargs(func, **kwargs):
+    """Return the keyword arguments that func accepts - older versions of the pipeline do not have every argument the
+    harness passes (e.g. show_progress, workers), so these are only passed where they exist"""
+    parameters = inspect.signature(func).parameters
+    return {key: value for key, value in kwargs.items() if key in parameters}
+
+def process_peak_rss_mb():
+    """Return the peak resident memory of this process so far in MB, None where it is not available"""
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+
+def run_stage(name, func, setup=None, repeat=3, trace_memory=True):
+    """Time a stage of the pipeline and record its peak memory
+    func: the function to benchmark - it is called with the arguments returned by setup
+    setup: a function that returns a tuple of arguments for func - it is run before each call and is not timed (use it to
+    copy inputs that func changes)
+    repeat: number of timed runs - the fastest is reported as wall_s
+    trace_memory: run the stage once more under tracemalloc to record the peak memory allocated by the stage (tracemalloc
+    slows the code down, so it is never used in the timed runs)
+    Returns: dict of the results for the stage, the return value of the last call to func"""
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+
+    stage = {"stage": name, "wall_s": min(times), "wall_s_runs": times}
+    if trace_memory:
+        args = setup() if setup else ()
+        tracemalloc.start()
+        result = func(*args)
+        stage["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    stage["max_rss_mb"] = process_peak_rss_mb()
+
+    print(f"{name}: {stage['wall_s']:.3f}s" + (f", peak {stage['peak_traced_mb']:.1f}MB" if trace_memory else ""))
+    return stage, result
+
+def git_commit(code_dir=None):
+    """Return the current commit of the repository (or of the checkout in code_dir), if it can be found"""
+    try:
+        return subprocess.run(["git", "-C", code_dir or ".", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(data_dir, scale_params, repeat=3, trace_memory=True, seed=1, code_dir=None):
+    """Generate (or reuse) the synthetic data in data_dir and benchmark each stage of the pipeline on it
+    code_dir: benchmark the pipeline code of another checkout of the repository (see load_pipeline)
+    Returns: dict with the metadata of the run and a list of stage results"""
+    pipeline = load_pipeline(code_dir)
+    load_all_cls = pipeline["utilities.load_all_cls"].load_all_cls
+    clusterDf = pipeline["utilities.clusterDf"].clusterDf
+    gapsClusters = pipeline["utilities.data_parsing"].gapsClusters
+    query_book = pipeline["find_shared_gaps.find_shared_gaps"].query_book
+    populate_offset_text = pipeline["find_shared_gaps.find_shared_gaps"].populate_offset_text
+    create_path_dict = pipeline["find_shared_gaps.find_shared_gaps"].create_path_dict
+
+    corpus = ensure_corpus(data_dir, seed=seed, **scale_params)
+    stages = []
+
+    # Loading the cluster data in each format
+    for file_format, path_key in [("csv", "csv_path"), ("parquet", "parquet_dir"), ("json", "json_dir")]:
+        stage, cluster_data = run_stage(f"load_all_cls[{file_format}]", lambda path=corpus[path_key]: load_all_cls(path, corpus["meta_path"]),
+                                        repeat=repeat, trace_memory=trace_memory)
+        stage["rows"] = len(cluster_data)
+        stages.append(stage)
+
+    # Building the cluster object
+    stage, cluster_obj = run_stage("clusterDf", lambda: clusterDf(corpus["csv_path"], corpus["meta_path"]), repeat=repeat,
+                                   trace_memory=trace_memory)
+    stage["rows"] = len(cluster_obj.cluster_df)
+    stages.append(stage)
+
+    # Gap search - every book in turn (in one process), as query_corpus does
+    books = sorted(cluster_obj.cluster_df["book"].drop_duplicates().to_list())
+    def query_all_books():
+        gap_data = []
+        for book in books:
+            gap_data.extend(query_book(cluster_obj, book, index_start=len(gap_data), **accepted_kwargs(query_book, show_progress=False)))
+        return gap_data
+    stage, gap_data = run_stage("query_book", query_all_books, repeat=repeat, trace_memory=trace_memory)
+    stage["books"] = len(books)
+    stage["gaps"] = len(gap_data)
+    stages.append(stage)
+
+    # Fetching the text of the gaps - in one process so that the memory of the stage can be traced
+    path_dict = create_path_dict(corpus["meta_path"], corpus["corpus_dir"])
+    stage, populated = run_stage("populate_offset_text",
+                                 lambda gaps: populate_offset_text(gaps, path_dict, fetch_context=True, trim_context=10,
+                                                                   **accepted_kwargs(populate_offset_text, workers=1)),
+                                 setup=lambda: (copy.deepcopy(gap_data),), repeat=repeat, trace_memory=trace_memory)
+    stages.append(stage)
+
+    # Pairs and exports
+    stage, pairs = run_stage("parse_to_pairs", lambda: gapsClusters(populated).parse_to_pairs(), repeat=repeat,
+                             trace_memory=trace_memory)
+    stage["pairs"] = len(pairs)
+    stages.append(stage)
+
+    export_dir = os.path.join(data_dir, "exports")
+    def export(method):
+        if os.path.exists(export_dir):
+            shutil.rmtree(export_dir)
+        getattr(gapsClusters(populated), method)(export_dir, sep_pairwise=True)
+    for method in ["export_csv", "export_label_studio_json"]:
+        stage, _ = run_stage(method, lambda method=method: export(method), repeat=repeat, trace_memory=trace_memory)
+        stages.append(stage)
+    shutil.rmtree(export_dir, ignore_errors=True)
+
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(code_dir),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "seed": seed,
+            "scale": scale_params,
+            "repeat": repeat,
+            "corpus": corpus
+        },
+        "stages": stages
+    }
+
+def compare_results(old_path, new_path):
+    """Print the change in time and peak memory of each stage between two results jsons"""
+    with open(old_path, "r", encoding="utf-8") as f:
+        old = {stage["stage"]: stage for stage in json.load(f)["stages"]}
+    with open(new_path, "r", encoding="utf-8") as f:
+        new = {stage["stage"]: stage for stage in json.load(f)["stages"]}
+
+    print(f"{'stage':<30}{'old s':>10}{'new s':>10}{'speedup':>10}{'old MB':>10}{'new MB':>10}")
+    for name, new_stage in new.items():
+        if name not in old:
+            continue
+        old_stage = old[name]
+        speedup = old_stage["wall_s"] / new_stage["wall_s"] if new_stage["wall_s"] > 0 else float("inf")
+        old_mb = old_stage.get("peak_traced_mb", float("nan"))
+        new_mb = new_stage.get("peak_traced_mb", float("nan"))
+        print(f"{name:<30}{old_stage['wall_s']:>10.3f}{new_stage['wall_s']:>10.3f}{speedup:>9.2f}x{old_mb:>10.1f}{new_mb:>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the gaps pipeline on synthetic data")
+    parser.add_argument("--scale", choices=SCALES.keys(), default="small", help="size of the synthetic corpus")
+    parser.add_argument("--books", type=int, help="override the number of books for the scale")
+    parser.add_argument("--chains", type=int, help="override the number of reuse chains for the scale")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs of each stage")
+    parser.add_argument("--no-memory", action="store_true", help="do not run the stages under tracemalloc")
+    parser.add_argument("--data-dir", default="benchmarks/data", help="directory for the generated data")
+    parser.add_argument("--out", help="path of the results json - defaults to benchmarks/results/{scale}_{timestamp}.json")
+    parser.add_argument("--code-dir", help="benchmark the pipeline code of another checkout of the repository (e.g. a git worktree of the baseline commit)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two results jsons and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results(*args.compare)
+        sys.exit()
+
+    scale_params = dict(SCALES[args.scale])
+    if args.books:
+        scale_params["n_books"] = args.books
+    if args.chains:
+        scale_params["n_chains"] = args.chains
+    data_dir = os.path.join(args.data_dir, f"{args.scale}_seed{args.seed}")
+
+    results = run_benchmarks(data_dir, scale_params, repeat=args.repeat, trace_memory=not args.no_memory, seed=args.seed,
+                             code_dir=args.code_dir)
+
+    out_path = args.out
+    if out_path is None:
+        os.makedirs("benchmarks/results", exist_ok=True)
+        out_path = os.path.join("benchmarks/results", f"{args.scale}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=4)
+    print(f"Results saved to {out_path}")
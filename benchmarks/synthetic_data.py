@@ -0,0 +1,129 @@
+"""Seeded generator of synthetic passim and OpenITI data for the benchmarks. Produces, in one output directory:
+meta.csv - a metadata TSV in the format of the OpenITI metadata (id, book, date, status, local_path)
+corpus/ - an mARkdown text for each book with msNNNN milestone markers, in the OpenITI folder structure
+clusters.csv - minified clusters (the csv format read by load_all_cls)
+parquet/ and json/ - the full cluster schema split over several parquet and JSON-lines files
+The same parameters and seed always produce the same data. The reuse offsets are measured against the cleaned milestones
+(the same cleaning that passim offsets refer to), so the gap search and the text fetching run on valid positions"""
+from openiti.helper.funcs import text_cleaner
+import pandas as pd
+import random
+import json
+import os
+
+LETTERS = "ابتثجحخدذرزسشصضطظعغفقكلمنهوي"
+
+def _random_word(rand):
+    return "".join(rand.choice(LETTERS) for _ in range(rand.randint(2, 7)))
+
+def generate_corpus(out_dir, n_books=12, n_ms=40, words_per_ms=300, n_chains=150, cluster_files=3, seed=1):
+    """Write a synthetic corpus and cluster data to out_dir
+    n_books: number of books in the corpus
+    n_ms: number of milestones in each book
+    words_per_ms: number of words in each milestone
+    n_chains: number of chains of reuse - each chain is a group of 2 to 4 books that share a run of 2 to 6 consecutive
+    clusters (the runs create the gaps the pipeline looks for). The same number of isolated clusters is added as noise
+    cluster_files: number of files the parquet and json cluster data are split over
+    seed: random seed
+    Returns: dict of the paths of the generated data (meta_path, corpus_dir, csv_path, parquet_dir, json_dir) and stats"""
+    rand = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Create the books and the metadata
+    books = []
+    meta = []
+    for i in range(n_books):
+        date = rand.randint(100, 900)
+        uri = f"{date:04d}Author{i}.Book{i}"
+        version_id = f"JK{i:06d}"
+        local_path = f"data/{uri.split('.')[0]}/{uri}/{uri}.{version_id}-ara1.mARkdown"
+        books.append((uri, version_id, local_path))
+        meta.append({"id": version_id, "book": uri, "date": date, "status": "pri", "local_path": "../" + local_path})
+    meta_path = os.path.join(out_dir, "meta.csv")
+    pd.DataFrame(meta).to_csv(meta_path, sep="\t", index=False)
+
+    # Write the texts - record the cleaned length of each milestone so the reuse offsets stay inside the milestones
+    corpus_dir = os.path.join(out_dir, "corpus")
+    ms_lengths = {}
+    for uri, version_id, local_path in books:
+        text_path = os.path.join(corpus_dir, local_path)
+        os.makedirs(os.path.dirname(text_path), exist_ok=True)
+        parts = ["######OpenITI#\n\n#META# 000.SortField :: synthetic\n#META#Header#End#\n\n"]
+        lengths = {}
+        for ms in range(1, n_ms + 1):
+            ms_text = "# " + " ".join(_random_word(rand) for _ in range(words_per_ms)) + " "
+            lengths[ms] = len(text_cleaner(ms_text))
+            parts.append(ms_text + f"ms{ms:04d}\n")
+        with open(text_path, "w", encoding="utf-8") as f:
+            f.write("".join(parts))
+        ms_lengths[uri] = lengths
+
+    # Create chains of clusters - each member book moves forward through its text between clusters
+    rows = []
+    cluster = 0
+    for _ in range(n_chains):
+        members = rand.sample(books, rand.randint(2, min(4, n_books)))
+        positions = {uri: (rand.randint(1, max(1, n_ms - 3)), rand.randint(0, 400)) for uri, _, _ in members}
+        for _ in range(rand.randint(2, 6)):
+            cluster += 1
+            for uri, version_id, _ in members:
+                seq, ch = positions[uri]
+                length = rand.randint(30, 200)
+                if ch + length >= ms_lengths[uri][seq]:
+                    seq = min(seq + 1, n_ms)
+                    ch = rand.randint(0, 50)
+                end = max(ch, min(ch + length, ms_lengths[uri][seq] - 1))
+                rows.append({"cluster": cluster, "id": version_id, "seq": seq, "begin": ch, "end": end, "series": f"{version_id}-ara1"})
+                positions[uri] = (seq, end + rand.randint(0, 300))
+
+    # Add isolated clusters as noise (including single book clusters, which are dropped by clusterDf)
+    for _ in range(n_chains):
+        cluster += 1
+        for uri, version_id, _ in rand.sample(books, rand.randint(1, min(3, n_books))):
+            seq = rand.randint(1, n_ms)
+            begin = rand.randint(0, max(0, ms_lengths[uri][seq] - 60))
+            rows.append({"cluster": cluster, "id": version_id, "seq": seq, "begin": begin, "end": begin + 50, "series": f"{version_id}-ara1"})
+
+    clusters_df = pd.DataFrame(rows)
+    clusters_df["size"] = clusters_df.groupby("cluster")["cluster"].transform("size")
+
+    # Minified csv
+    csv_path = os.path.join(out_dir, "clusters.csv")
+    clusters_df[["cluster", "id", "seq", "begin", "end", "size"]].to_csv(csv_path)
+
+    # Full schema split over parquet and json-lines files
+    clusters_df["uid"] = range(len(clusters_df))
+    clusters_df["gid"] = clusters_df["uid"]
+    clusters_df["text"] = "synthetic"
+    columns = ["uid", "gid", "cluster", "size", "seq", "series", "text", "begin", "end"]
+    parquet_dir = os.path.join(out_dir, "parquet")
+    json_dir = os.path.join(out_dir, "json")
+    os.makedirs(parquet_dir, exist_ok=True)
+    os.makedirs(json_dir, exist_ok=True)
+    for i in range(cluster_files):
+        part = clusters_df.iloc[i::cluster_files][columns]
+        part.to_parquet(os.path.join(parquet_dir, f"part-{i:05d}.parquet"), index=False)
+        part.to_json(os.path.join(json_dir, f"part-{i:05d}.json"), orient="records", lines=True, force_ascii=False)
+
+    return {"meta_path": meta_path, "corpus_dir": corpus_dir, "csv_path": csv_path, "parquet_dir": parquet_dir,
+            "json_dir": json_dir, "books": len(books), "cluster_rows": len(clusters_df), "clusters": cluster}
+
+def ensure_corpus(out_dir, **params):
+    """Generate the corpus in out_dir unless it has already been generated there with the same parameters
+    Returns: the dict produced by generate_corpus"""
+    params_path = os.path.join(out_dir, "params.json")
+    if os.path.exists(params_path):
+        with open(params_path, "r", encoding="utf-8") as f:
+            stored = json.load(f)
+        if stored["params"] == params:
+            return stored["corpus"]
+
+    print(f"Generating synthetic corpus in {out_dir}")
+    corpus = generate_corpus(out_dir, **params)
+    with open(params_path, "w", encoding="utf-8") as f:
+        json.dump({"params": params, "corpus": corpus}, f, indent=4)
+    return corpus
+
+
+if __name__ == "__main__":
+    generate_corpus("benchmarks/data/small")
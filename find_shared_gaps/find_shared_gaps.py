@@ -1,42 +1,83 @@
 from utilities.clusterDf import clusterDf
 from utilities.openitiTexts import openitiTextMs
-from utilities.data_parsing import gapsClusters
+from utilities.data_parsing import gapsClusters, gapsWriter, ndjsonGaps
+from utilities.cache_utils import hash_key, hash_frame, contentHashCache
+from utilities.instrumentation import get_metrics, set_metrics, pipelineMetrics, init_worker_metrics
+from utilities.intervalIndex import build_book_interval_index
+from utilities.msLengths import build_ms_length_tables, notional_ms_lengths, merge_ms_lengths, stacked_book_offsets
+from utilities.cleanedStore import cleanedCorpusStore
 import json
 import re
 import pandas as pd
+import numpy as np
 import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from tqdm import tqdm
 
-def check_gap(prev_dict, next_dict, min_gap, av_word_len=4):
+# Part of every checkpoint key - increase it when a change to the gap search or the text fetching changes the output, so
+# that checkpoints written by older versions are not reused
+CHECKPOINT_VERSION = 3
+
+def check_gap(prev_dict, next_dict, min_gap, av_word_len=4, ms_lengths=None):
     """
     Take dict data from cluster rows and compare them to see if they meet the match criteria
     prev_dict: dict of the first row (before the hypothesised gap) from the cluster data
     next_dict: dict of the next row (after the hypothesised gap) from the cluster data
     min_gap: the minimum gap size to meet criteria
     av_word_len: average word length in corpus in ch, used to create a theoretical length of the milestones in chs - not a precise measurement
+    ms_lengths: the bookMsLengths for the book of the rows (from an msLengthTable or book_clusters_ms_lengths). The
+    gap is measured between the positions of the rows in the book, whatever the number of milestones between them. Milestones
+    that are not in the table (or all milestones if None) are given a notional length (see msLengths.notional_ms_lengths)
 
     Returns:
     bool: true means there is a gap, false means the gap does not meet criteria
     """
-    gap = False
-    ms_gap = next_dict["seq"] - prev_dict["seq"]
-    # If the ms (seq) is the same, calculate gap between 'end' of book_ms and 'begin' of next_ms
-    if ms_gap == 0:
-        gap_len = next_dict["begin"] - prev_dict["end"]
-        if gap_len > min_gap:
-            gap = True
-   
-    # If the ms are consecutive gap take notional ch length of ms (4*300) - 'end' of book_ms, if negative number use 0 + "begin" of following ms
-    elif ms_gap == 1:
-        prev_gap = (av_word_len * 300) - prev_dict["end"]
-        if prev_gap < 0:
-            prev_gap = 0
-        next_gap = next_dict["begin"]
-        gap_len = next_gap - prev_gap
-        if gap_len > min_gap:
-            gap = True
-
-    return gap
+    return bool(check_gap_arrays(np.array([prev_dict["seq"]]), np.array([prev_dict["end"]]), np.array([next_dict["seq"]]),
+                                 np.array([next_dict["begin"]]), min_gap, av_word_len=av_word_len, ms_lengths=ms_lengths)[0])
+
+def check_gap_arrays(prev_seq, prev_end, next_seq, next_begin, min_gap, av_word_len=4, ms_lengths=None):
+    """Columnar version of check_gap - takes numpy arrays of the fields used by check_gap (one item per pair of rows) and
+    returns a boolean array where true means the gap meets the criteria. Each position is converted to a character offset
+    from the start of the book with a prefix sum of the milestone lengths, so the gap is a subtraction for any number of
+    milestones between the rows
+    ms_lengths: the bookMsLengths for the book that all of the rows belong to - see check_gap"""
+    notional = notional_ms_lengths(np.concatenate([prev_seq, next_seq]), np.concatenate([prev_end, next_begin]), av_word_len=av_word_len)
+    positions = merge_ms_lengths(ms_lengths, notional)
+    gap_len = positions.to_book_offsets(next_seq, next_begin) - positions.to_book_offsets(prev_seq, prev_end)
+    return (next_seq >= prev_seq) & (gap_len > min_gap)
+
+def book_clusters_ms_lengths(book_clusters, ms_lengths=None, av_word_len=4):
+    """Return a dict of book uri to the bookMsLengths used to convert the (seq, begin/end) positions of that book's rows in
+    book_clusters into character offsets from the start of the book. Exact lengths are taken from ms_lengths (an
+    msLengthTable) where it holds the milestone, the rest are notional (see msLengths.notional_ms_lengths). The notional
+    lengths are built only from the rows in book_clusters - so a book's gaps depend only on the rows its checkpoint key is
+    built from (see book_checkpoint_key)"""
+    seqs = book_clusters["seq"].to_numpy()
+    begins = book_clusters["begin"].to_numpy()
+    ends = book_clusters["end"].to_numpy()
+    tables = {}
+    for book, positions in book_clusters.groupby("book", sort=False, observed=True).indices.items():
+        notional = notional_ms_lengths(np.concatenate([seqs[positions], seqs[positions]]),
+                                       np.concatenate([begins[positions], ends[positions]]), av_word_len=av_word_len)
+        tables[book] = merge_ms_lengths(ms_lengths.get(book) if ms_lengths is not None else None, notional)
+    return tables
+
+def _matching_gap_mask(matches, min_gap, book_tables):
+    """Apply the gap criteria to a df of before/after rows from different books - the positions of the rows of every book
+    are converted to book offsets in one pass, each with that book's milestone lengths
+    book_tables: dict of book uri to bookMsLengths (see book_clusters_ms_lengths)"""
+    codes, books = pd.factorize(matches["book"])
+    tables = [book_tables[book] for book in books]
+    seq_before = matches["seq_before"].to_numpy()
+    seq_after = matches["seq_after"].to_numpy()
+    gap_len = (stacked_book_offsets(tables, codes, seq_after, matches["begin_after"].to_numpy())
+               - stacked_book_offsets(tables, codes, seq_before, matches["end_before"].to_numpy()))
+    return (seq_after >= seq_before) & (gap_len > min_gap)
+
+def _row_dict(book, seq, begin, end):
+    """Build the minimal cluster-row dict needed by create_gap_dict from values taken from the cluster arrays"""
+    return {"book": book, "seq": seq, "begin": begin, "end": end}
 
 def create_gap_dict(prev_dict, next_dict):
     """Take a record of previous and next cluster data and convert it into a dictionary that documents the gap
@@ -55,7 +96,17 @@ def create_gap_dict(prev_dict, next_dict):
 
         return {"book": prev_uri, "start": start, "end": end, "before": before, "after": after}
 
-def query_book(cluster_obj, book_uri, min_gap=12, index_start = 0, data_check=False):
+def book_death_date(book_uri):
+    """Return the death date in the book uri"""
+    return int(re.findall(r"\d+", book_uri)[0])
+
+def fetch_book_clusters(cluster_obj, book_uri):
+    """Fetch the rows of every cluster that the book is in - only for books dating before the book_uri death date. These
+    are all of the rows that query_book uses for the book"""
+    return cluster_obj.return_cluster_df_for_uri_ms(book_uri, min_date=0, max_date=book_death_date(book_uri))
+
+def query_book(cluster_obj, book_uri, min_gap=12, index_start = 0, data_check=False, show_progress=True, ms_lengths=None, coverage=None,
+               max_covered=0):
     """Take one book URI and fetch gaps as dict of aligned gaps
     In:
     book_uri: a book uri which is the base text for comparison, version URI not needed
@@ -64,6 +115,17 @@ def query_book(cluster_obj, book_uri, min_gap=12, index_start = 0, data_check=Fa
     index_start: the first index of the output dict. Used when running a whole corpus to ensure that all identifiers are unique
     data_check: if you want to check the results against the input data, set this to true and it will return all of the rows of the
     cluster data that were used to support a result
+    show_progress: show a tqdm bar while stepping through the book - switched off when running inside query_corpus workers
+    ms_lengths: an msLengthTable - if given, gaps are measured using the real length of the milestones, otherwise with notional
+    milestone lengths (see check_gap). Gaps are found across any number of milestones
+    coverage: check whether each gap in the book is covered by any other alignment of the book with a text dated up to the
+    book_uri death date (the heuristic in the README), using an interval index of the book's alignments (see utilities.intervalIndex)
+        None: no check (default)
+        "annotate": add "coverage": {"gap_chars": n, "covered_chars": n} to each result
+        "filter": drop the gaps with more than max_covered characters covered
+    Positions are exact if ms_lengths has a table for the book, otherwise notional milestone lengths are used for gaps
+    that cross milestones
+    max_covered: the number of covered characters allowed when coverage="filter"
     Returns: type dict
     [
         {"index": 1,
@@ -81,78 +143,128 @@ def query_book(cluster_obj, book_uri, min_gap=12, index_start = 0, data_check=Fa
             }
         }
     ]
-    To do: once this code is working - pass a ms text dict to this function and use it to get real ms lens in char - pass the full
-    ms text to the output to allow us to use it in the next processing steps (avoid high IO ops)
+    To do: pass the full ms text to the output to allow us to use it in the next processing steps (avoid high IO ops)
     """
 
     # Create empty list for adding data
     out_data = []
 
+    # A book that shares no cluster with a book dated up to its death date can have no aligned gaps. Only checked when the
+    # reuse matrix is already built - building it for a single book costs more than the search
+    if cluster_obj.has_reuse_matrix() and not cluster_obj.shares_clusters(book_uri, max_date=book_death_date(book_uri)):
+        get_metrics().count("books_without_reuse")
+        return out_data
+
     # Fetch a df of the clusters for the given book_uri - only for books dating before the book_uri death date
-    death_date = int(re.findall("\d+", book_uri)[0])
-    book_clusters = cluster_obj.return_cluster_df_for_uri_ms(book_uri, min_date=0, max_date=death_date)
+    book_clusters = fetch_book_clusters(cluster_obj, book_uri)
 
+    # Without a row from another book there is nothing for a gap to match
+    if not (book_clusters["book"] != book_uri).any():
+        get_metrics().count("books_without_reuse")
+        return out_data
 
     # Get the milestones for the clusters in the main book
-    book_dict = book_clusters[book_clusters["book"] == book_uri].sort_values(by= ["seq", "begin"]).to_dict("records")
-
-    # Advance through book_dict, one-by-one, calculate gap, if meets min_gap, see if there are shared books in the pair, then find gaps for those
-    for idx, current_row in enumerate(tqdm(book_dict[:-1])):
-        
-        # Get the next row
-        next_row = book_dict[idx + 1]
-
-        # Check the gap
-        gap = check_gap(current_row, next_row, min_gap)
-
-        if gap:
-            book_list = []
-            # If gap criteria fit check for matching gaps on other side of relationship
-            matching_gaps = []
-            # Get cluster dfs for either side of relationship
-            reuse_before = book_clusters[book_clusters["cluster"] == current_row["cluster"]] 
-            reuse_after = book_clusters[book_clusters["cluster"] == next_row["cluster"]] 
-
-            # Get matching books
-            books_before = reuse_before["book"].drop_duplicates().to_list()
-            books_after = reuse_after["book"].drop_duplicates().to_list()
-            matching_books = []
-            for book in books_before:
-                if book in books_after and book != book_uri:
-                    matching_books.append(book)
-
-            # For matching books see if gap condition is met - store cases where it is
-            for matching_book in matching_books:
-                dicts_before = reuse_before[reuse_before["book"] == matching_book].to_dict("records")
-                dicts_after = reuse_after[reuse_after["book"] == matching_book].to_dict("records")
-                for before_dict in dicts_before:
-                    for after_dict in dicts_after:
-                        matching_gap = check_gap(before_dict, after_dict, min_gap=min_gap)
-                        if matching_gap:
-                            gap_dict = create_gap_dict(before_dict, after_dict)
-                            matching_gaps.append(gap_dict)
-                            book_list.append(matching_book)
-            
-            if len(matching_gaps) > 0:
-                index_start +=1
-                main_dict = create_gap_dict(current_row, next_row)
-                book_list.append(book_uri)
-                if data_check:
-                    out_dict = {
-                            "index": index_start,
-                            "gaps_data": [main_dict] + matching_gaps,
-                            "books": book_list,
-                            "supporting_data": {
-                                "before": reuse_before.to_dict("records"),
-                                "after": reuse_after.to_dict("records")}
-                            }
-                else:
-                    out_dict = {
-                        "index": index_start,
-                        "gaps_data": [main_dict] + matching_gaps,
-                        "books": book_list
-                        }
-                out_data.append(out_dict)
+    book_rows = book_clusters[book_clusters["book"] == book_uri].sort_values(by= ["seq", "begin"])
+    if len(book_rows) < 2:
+        return out_data
+
+    # Convert every row of the book to character offsets from the start of the book in one pass - the gap between each row
+    # and the next one is then a subtraction of shifted arrays
+    seqs = book_rows["seq"].to_numpy()
+    begins = book_rows["begin"].to_numpy()
+    ends = book_rows["end"].to_numpy()
+    clusters = book_rows["cluster"].to_numpy()
+    book_tables = book_clusters_ms_lengths(book_clusters, ms_lengths)
+    positions = book_tables[book_uri]
+    begin_offsets = positions.to_book_offsets(seqs, begins)
+    end_offsets = positions.to_book_offsets(seqs, ends)
+    gap_mask = begin_offsets[1:] - end_offsets[:-1] > min_gap
+    candidates = np.flatnonzero(gap_mask)
+    metrics = get_metrics()
+    metrics.count("gap_rows_checked", len(gap_mask))
+    metrics.count("candidate_gaps", len(candidates))
+
+    # Check every candidate against the interval index of the book's alignments with texts up to the death date
+    if coverage is not None and len(candidates) > 0:
+        interval_index = build_book_interval_index(book_clusters, book_uri, positions)
+        gap_starts = end_offsets[candidates]
+        gap_ends = begin_offsets[candidates + 1]
+        covered = interval_index.covered_length(gap_starts, gap_ends)
+        if coverage == "filter":
+            keep = covered <= max_covered
+            metrics.count("covered_gaps_dropped", int((~keep).sum()))
+            candidates, gap_starts, gap_ends, covered = candidates[keep], gap_starts[keep], gap_ends[keep], covered[keep]
+        candidate_coverage = {candidate: {"gap_chars": int(max(gap_end - gap_start, 0)), "covered_chars": int(covered_chars)}
+                              for candidate, gap_start, gap_end, covered_chars in zip(candidates.tolist(), gap_starts, gap_ends, covered)}
+
+    if len(candidates) == 0:
+        return out_data
+
+    # Join the before and after clusters of every candidate to the rows of the other books in those clusters in one merge.
+    # 'pos' keeps the order of the rows in book_clusters, so the output is ordered as it was by the row-by-row approach
+    other_rows = pd.DataFrame({
+        "cluster": book_clusters["cluster"].to_numpy(),
+        "book": book_clusters["book"].to_numpy(),
+        "seq": book_clusters["seq"].to_numpy(),
+        "begin": book_clusters["begin"].to_numpy(),
+        "end": book_clusters["end"].to_numpy(),
+        "pos": np.arange(len(book_clusters))})
+    other_rows = other_rows[other_rows["book"] != book_uri]
+    sides = pd.DataFrame({
+        "candidate": np.concatenate([candidates, candidates]),
+        "side": np.repeat([0, 1], len(candidates)),
+        "cluster": np.concatenate([clusters[candidates], clusters[candidates + 1]])})
+    sides = sides.merge(other_rows, on="cluster")
+
+    # Pair every before row with every after row from the same book
+    before = sides[sides["side"] == 0].drop(columns=["side", "cluster"])
+    after = sides[sides["side"] == 1].drop(columns=["side", "cluster"])
+    matches = before.merge(after, on=["candidate", "book"], suffixes=("_before", "_after"))
+
+    # Evaluate the gap condition for the matching books and keep the rows that meet it
+    metrics.count("matching_gaps_checked", len(matches))
+    matches = matches[_matching_gap_mask(matches, min_gap, book_tables)].copy()
+
+    # Order the matches as: candidate, first appearance of the book in the before cluster, before row, after row
+    matches["book_order"] = matches.groupby(["candidate", "book"])["pos_before"].transform("min")
+    matches = matches.sort_values(by=["candidate", "book_order", "pos_before", "pos_after"], kind="stable")
+
+    # If we need the supporting data - only fetch the cluster rows for the clusters that are used
+    if data_check:
+        used_candidates = matches["candidate"].drop_duplicates().to_numpy()
+        used_clusters = np.unique(np.concatenate([clusters[used_candidates], clusters[used_candidates + 1]]))
+        supporting = book_clusters[book_clusters["cluster"].isin(used_clusters)]
+        supporting_dicts = {cluster: rows.to_dict("records") for cluster, rows in supporting.groupby("cluster", sort=False)}
+
+    # Build the output dicts - one per candidate that has at least one matching gap
+    book_seqs, book_begins, book_ends, book_clusters_list = seqs.tolist(), begins.tolist(), ends.tolist(), clusters.tolist()
+    match_columns = [matches[column].tolist() for column in ["candidate", "book", "seq_before", "begin_before", "end_before",
+                                                             "seq_after", "begin_after", "end_after"]]
+    grouped_matches = {}
+    for candidate, book, seq_b, begin_b, end_b, seq_a, begin_a, end_a in zip(*match_columns):
+        grouped_matches.setdefault(candidate, []).append(
+            (book, create_gap_dict(_row_dict(book, seq_b, begin_b, end_b), _row_dict(book, seq_a, begin_a, end_a))))
+
+    for candidate in tqdm(grouped_matches, disable=not show_progress):
+        matching = grouped_matches[candidate]
+        index_start +=1
+        current_row = _row_dict(book_uri, book_seqs[candidate], book_begins[candidate], book_ends[candidate])
+        next_row = _row_dict(book_uri, book_seqs[candidate + 1], book_begins[candidate + 1], book_ends[candidate + 1])
+        main_dict = create_gap_dict(current_row, next_row)
+        book_list = [book for book, _ in matching] + [book_uri]
+        out_dict = {
+            "index": index_start,
+            "gaps_data": [main_dict] + [gap_dict for _, gap_dict in matching],
+            "books": book_list
+            }
+        if coverage == "annotate":
+            out_dict["coverage"] = candidate_coverage[candidate]
+        if data_check:
+            out_dict["supporting_data"] = {
+                "before": supporting_dicts[book_clusters_list[candidate]],
+                "after": supporting_dicts[book_clusters_list[candidate + 1]]}
+        out_data.append(out_dict)
+    metrics.count("gaps_emitted", len(out_data))
 
     # Return the results
     return out_data
@@ -174,99 +286,446 @@ def create_path_dict(meta_path, openiti_base_dir):
 
 
 
-def populate_offset_text(gap_data, path_dict, offset_padding=0, fetch_context=False, trim_context=0):
-    """Take gap data and add text field by parsing the relevant openiti texts"""
+def open_book_text(book, path_dict, store=None):
+    """Open the text of a book for fetching offsets - from the store of cleaned texts if it holds the book, otherwise from the
+    OpenITI text. Only a few milestones are needed from each text - so the lazy mode is used rather than splitting the whole text"""
+    if store is not None and book in store:
+        return store.open_book(book)
+    return openitiTextMs(path_dict[book], lazy=True, use_mmap=True)
+
+def fetch_gap_texts(ms_obj, gaps, offset_padding=0, fetch_context=False, trim_context=0):
+    """Fetch the text (and the context if fetch_context) for a list of gaps from one book
+    Returns: a list with a dict of the text fields for each gap, in the order of gaps"""
+    texts = []
+    for gap in gaps:
+        text = ms_obj.fetch_range_clean(gap["start"]["ms"], gap["start"]["ch"], gap["end"]["ms"], gap["end"]["ch"], padding=offset_padding)
+        gap_texts = {"text": text}
+
+        if fetch_context:
+            gap_texts["text_before"] = ms_obj.fetch_offset_clean(gap["before"]["ms"], 
+                                start=gap["before"]["start_ch"], end=gap["before"]["end_ch"],
+                                trim = trim_context)
+            gap_texts["text_after"] = ms_obj.fetch_offset_clean(gap["after"]["ms"], 
+                                start=gap["after"]["start_ch"], end=gap["after"]["end_ch"],
+                                trim = trim_context)
+        texts.append(gap_texts)
+    return texts
+
+def _populate_book_worker(book, path_dict, store_dir, gaps, offset_padding, fetch_context, trim_context):
+    """Load one text inside a worker process and fetch the texts for all of its gaps
+    Returns: the book, the texts, the number of milestones that were cleaned and the number read from the store of
+    cleaned texts (for the metrics of the main process)"""
+    store = cleanedCorpusStore(store_dir) if store_dir else None
+    ms_obj = open_book_text(book, path_dict, store)
+    texts = fetch_gap_texts(ms_obj, gaps, offset_padding=offset_padding, fetch_context=fetch_context, trim_context=trim_context)
+    ms_obj.close()
+    return book, texts, ms_obj.clean_cache_misses, getattr(ms_obj, "store_reads", 0)
+
+def populate_offset_text(gap_data, path_dict, offset_padding=0, fetch_context=False, trim_context=0, store_dir=None, workers=None):
+    """Take gap data and add text field by parsing the relevant openiti texts
+    store_dir: a store of pre-cleaned texts (see utilities.cleanedStore) - books in the store are read from there rather than
+    from the OpenITI texts
+    workers: number of processes used to load the texts (one book per task) - defaults to the number of cpus, if 1 the
+    books are loaded in this process"""
     
     # If fetch_context is set - ensure that we do not pad
     if fetch_context:
         offset_padding = 0
 
-    # Get list of all book names in gap_data
+    # Build an index of the gaps that belong to each book in one pass over gap_data
     print("Getting book names from data")
-    book_list = []
+    book_gaps = {}
     for row in tqdm(gap_data):
-        book_data = row["gaps_data"]
-        for dict_item in book_data:
-            book = dict_item["book"]
-            if book not in book_list:
-                book_list.append(book)
+        for gap in row["gaps_data"]:
+            book_gaps.setdefault(gap["book"], []).append(gap)
     
-    # Loop through each book - for each book loop through the data and populate the text according to specified offsets
-    for book in tqdm(book_list):
-        openiti_path = path_dict[book]
-        ms_obj = openitiTextMs(openiti_path)
-
-        for row in gap_data:
-            if book in row["books"]:
-                for gap in row["gaps_data"]:
-                    if gap["book"] == book:
-                        ms_start = gap["start"]["ms"]
-                        ms_end = gap["end"]["ms"]
-                        if ms_end - ms_start == 0:
-                            text = ms_obj.fetch_offset_clean(ms_start, start= gap["start"]["ch"], end = gap["end"]["ch"], padding=offset_padding)
-                        else:
-                            text = ms_obj.fetch_ms_list_clean([ms_start, ms_end], start=gap["start"]["ch"], end = gap["end"]["ch"], padding=offset_padding)
-   
-                        # Add text to the data
-                        gap["text"] = text
-
-                        if fetch_context:
-                            gap["text_before"] = ms_obj.fetch_offset_clean(gap["before"]["ms"], 
-                                                start=gap["before"]["start_ch"], end=gap["before"]["end_ch"],
-                                                trim = trim_context)
-                            gap["text_after"] = ms_obj.fetch_offset_clean(gap["after"]["ms"], 
-                                                start=gap["after"]["start_ch"], end=gap["after"]["end_ch"],
-                                                trim = trim_context)
+    # For each book fetch the texts for its gaps and add them to the data
+    metrics = get_metrics()
+    metrics.count("books_opened", len(book_gaps))
+    metrics.count("gap_texts_fetched", sum(len(gaps) for gaps in book_gaps.values()))
+    if workers is None:
+        workers = os.cpu_count()
+    if workers == 1 or len(book_gaps) <= 1:
+        store = cleanedCorpusStore(store_dir) if store_dir else None
+        for book, gaps in tqdm(book_gaps.items(), total=len(book_gaps)):
+            ms_obj = open_book_text(book, path_dict, store)
+            texts = fetch_gap_texts(ms_obj, gaps, offset_padding=offset_padding, fetch_context=fetch_context, trim_context=trim_context)
+            ms_obj.close()
+            metrics.count("milestones_cleaned", ms_obj.clean_cache_misses)
+            metrics.count("milestones_read_from_store", getattr(ms_obj, "store_reads", 0))
+            for gap, gap_texts in zip(gaps, texts):
+                gap.update(gap_texts)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker_metrics, initargs=(metrics.enabled,)) as executor:
+            futures = [executor.submit(_populate_book_worker, book, {book: path_dict.get(book)}, store_dir, gaps,
+                                       offset_padding, fetch_context, trim_context)
+                       for book, gaps in book_gaps.items()]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                book, texts, milestones_cleaned, store_reads = future.result()
+                metrics.count("milestones_cleaned", milestones_cleaned)
+                metrics.count("milestones_read_from_store", store_reads)
+                for gap, gap_texts in zip(book_gaps[book], texts):
+                    gap.update(gap_texts)
+
     # Return updated data
     return gap_data
 
-
-def query_corpus(cluster_obj, book_list = []):
-    """
-
+def iter_populated_books(book_results, path_dict, offset_padding=0, fetch_context=False, trim_context=0, store_dir=None, workers=None,
+                         batch_size=1000):
+    """Populate the gap texts of (book_uri, results) pairs as they are produced (e.g. by iter_query_corpus) and yield them
+    in the same order. Books are gathered until they hold batch_size gaps and each batch is populated with one call to
+    populate_offset_text, so the texts are loaded across the workers and a text is opened once per batch rather than
+    once for every book whose gaps it is part of
+    See populate_offset_text for the other parameters"""
+    batch = []
+    batch_gaps = 0
+    for book_uri, results in book_results:
+        batch.append((book_uri, results))
+        batch_gaps += len(results)
+        if batch_gaps >= batch_size:
+            populate_offset_text([row for _, results in batch for row in results], path_dict, offset_padding=offset_padding,
+                                 fetch_context=fetch_context, trim_context=trim_context, store_dir=store_dir, workers=workers)
+            yield from batch
+            batch = []
+            batch_gaps = 0
+    if batch_gaps > 0:
+        populate_offset_text([row for _, results in batch for row in results], path_dict, offset_padding=offset_padding,
+                             fetch_context=fetch_context, trim_context=trim_context, store_dir=store_dir, workers=workers)
+    yield from batch
+
+
+# Cluster object shared with the worker processes of query_corpus - set once per worker by _init_corpus_worker
+_worker_cluster_obj = None
+
+def _init_corpus_worker(cluster_obj, metrics_enabled=False):
+    """Store the cluster object in the worker process so that it is not re-sent with every book, and set up the worker's
+    metrics (see init_worker_metrics)"""
+    global _worker_cluster_obj
+    _worker_cluster_obj = cluster_obj
+    init_worker_metrics(metrics_enabled)
+
+def _query_book_worker(book_uri, min_gap, data_check, ms_lengths, coverage=None, max_covered=0):
+    """Run query_book inside a worker process. Indexes start at 0 - they are made globally unique by query_corpus
+    Returns: the book, its results and the counters of the worker's metrics for the book (for the main process)"""
+    results = query_book(_worker_cluster_obj, book_uri, min_gap=min_gap, data_check=data_check, show_progress=False,
+                         ms_lengths=ms_lengths, coverage=coverage, max_covered=max_covered)
+    return book_uri, results, get_metrics().take_counters()
+
+def iter_query_corpus(cluster_obj, book_list = [], min_gap=12, data_check=False, workers=None, ms_lengths=None, coverage=None,
+                      max_covered=0, max_held_gaps=100000):
+    """Generator version of query_corpus - yields (book_uri, results) for each book in book_list order as soon as the
+    results for that book (and every book before it) are ready, with the 'index' values already made globally unique.
+    Books that finish early are held until their turn, so the output order and indexes do not depend on the workers
+    max_held_gaps: the number of gaps of finished books to hold in memory while they wait for their turn - the results of
+    books that finish beyond this are written to a temporary file and read back when it is their turn. If None every
+    result is held in memory
+    See query_corpus for the other parameters"""
+
+    # If no books are given, use every book in the cluster data
+    if len(book_list) == 0:
+        book_list = sorted(cluster_obj.cluster_df["book"].drop_duplicates().to_list())
+    book_order = list(dict.fromkeys(book_list))
+    
+    # Books that share no cluster with a book dated up to their death date have no gaps - if the reuse matrix is already
+    # built or cached (see clusterDf) they are not run, otherwise query_book finds them from their own cluster rows
+    unshared = set()
+    if cluster_obj.reuse_matrix_available():
+        unshared = {book_uri for book_uri in book_order if not cluster_obj.shares_clusters(book_uri, max_date=book_death_date(book_uri))}
+        get_metrics().count("books_without_reuse", len(unshared))
+    to_query = len(book_order) - len(unshared)
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    # Offset each book's indexes by the number of gaps in the books before it in book_list order
+    index_start = 0
+    print(f"Querying {to_query} books across {workers} workers")
+    if workers == 1 or to_query <= 1:
+        for book_uri in tqdm(book_order):
+            results = []
+            if book_uri not in unshared:
+                results = query_book(cluster_obj, book_uri, min_gap=min_gap, data_check=data_check, show_progress=False,
+                                     ms_lengths=ms_lengths, coverage=coverage, max_covered=max_covered)
+            for row in results:
+                row["index"] += index_start
+            index_start += len(results)
+            yield book_uri, results
+    else:
+        # Submit the books with the most cluster rows first, so that the biggest texts do not hold up the end of the run - ties
+        # are broken by uri so the schedule is deterministic
+        row_counts = cluster_obj.cluster_df["book"].value_counts().to_dict()
+        schedule = sorted([book_uri for book_uri in book_order if book_uri not in unshared], key=lambda book: (-row_counts.get(book, 0), book))
+        metrics = get_metrics()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_corpus_worker, initargs=(cluster_obj, metrics.enabled)) as executor, \
+             tempfile.TemporaryDirectory() as spill_dir:
+            running = {executor.submit(_query_book_worker, book_uri, min_gap, data_check, ms_lengths, coverage, max_covered): book_uri
+                       for book_uri in schedule}
+            pending = {book_uri: [] for book_uri in unshared}
+            spilled = {}
+            held_gaps = 0
+            next_book = 0
+            progress = tqdm(total=len(running))
+            while next_book < len(book_order):
+                # Wait for the next book in order to be done - holding any other books that finish in the meantime
+                if book_order[next_book] not in pending and book_order[next_book] not in spilled:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        book_uri, results, counters = future.result()
+                        del running[future]
+                        for name, value in counters.items():
+                            metrics.count(name, value)
+                        progress.update(1)
+                        if book_uri != book_order[next_book] and max_held_gaps is not None and held_gaps + len(results) > max_held_gaps:
+                            spilled[book_uri] = os.path.join(spill_dir, f"{book_uri}.jsonl")
+                            with gapsWriter(spilled[book_uri]) as writer:
+                                writer.write_many(results)
+                        else:
+                            pending[book_uri] = results
+                            held_gaps += len(results)
+
+                # Release every book that is now next in order
+                while next_book < len(book_order) and (book_order[next_book] in pending or book_order[next_book] in spilled):
+                    book_uri = book_order[next_book]
+                    if book_uri in spilled:
+                        results = list(ndjsonGaps(spilled.pop(book_uri)))
+                    else:
+                        results = pending.pop(book_uri)
+                        held_gaps -= len(results)
+                    for row in results:
+                        row["index"] += index_start
+                    index_start += len(results)
+                    yield book_uri, results
+                    next_book += 1
+            progress.close()
+
+def query_corpus(cluster_obj, book_list = [], min_gap=12, data_check=False, workers=None, ms_lengths=None, coverage=None,
+                 max_covered=0):
+    """Run query_book for every book in book_list across a pool of processes and combine the results into one gap list
     In:
     cluster_obj: cluster object produced by the clusterDF class
     book_list: a list of book_uris to use, if empty run whole corpus, if one book only data for one book
-
+    min_gap: the minimum gap in characters between two reuse instances (passed to query_book)
+    data_check: passed to query_book - add the supporting cluster rows to each result
+    workers: number of processes to use - defaults to the number of cpus, if 1 the books are run in this process
+    ms_lengths: an msLengthTable passed to query_book
+    coverage: passed to query_book - check whether the gaps are covered by other alignments
+    max_covered: passed to query_book - the number of covered characters allowed when coverage="filter"
+    Returns: a list of dicts in the same format as query_book. Books are run largest first (by number of cluster rows) so
+    that the biggest texts do not hold up the end of the run, but the results are always combined in the order of book_list
+    (or sorted uri order for the whole corpus) so that the 'index' values are unique and the same whatever order the
+    workers finish in
     """
+    out_data = []
+    # Every result is kept, so there is no point writing the books that finish early to disk
+    for book_uri, results in iter_query_corpus(cluster_obj, book_list, min_gap=min_gap, data_check=data_check, workers=workers,
+                                               ms_lengths=ms_lengths, coverage=coverage, max_covered=max_covered, max_held_gaps=None):
+        out_data.extend(results)
+    
+    return out_data
 
 
-def run_pipeline(cluster_path, meta_path, openiti_base_dir, book_list = [], raw_gaps_out=None, fetch_context=False, trim_context=0, offset_padding=0):
+def book_checkpoint_key(cluster_obj, book_uri, path_dict, min_gap=12, fetch_context=False, trim_context=0, offset_padding=0,
+                        exact_lengths=False, coverage=None, max_covered=0, hash_cache=None):
+    """Build the key for a book's checkpoint from a hash of the cluster rows the book is queried with (see
+    fetch_book_clusters), the content hashes of the texts of the books in those clusters and the parameters of the run.
+    If the key is unchanged the book's gaps will be the same, so the checkpoint can be reused
+    hash_cache: a contentHashCache for the text hashes - so each text is only read once (and not again in later runs if
+    the cache is saved)"""
+    if hash_cache is None:
+        hash_cache = contentHashCache()
+    book_clusters = fetch_book_clusters(cluster_obj, book_uri)
+    rows_hash = hash_frame(book_clusters[["cluster", "book", "seq", "begin", "end"]])
+    books = sorted(book_clusters["book"].drop_duplicates().to_list())
+    text_hashes = [hash_cache.get(path_dict[book]) for book in books if book in path_dict and os.path.exists(path_dict[book])]
+    return hash_key(book_uri, rows_hash, text_hashes, version=CHECKPOINT_VERSION, min_gap=min_gap, fetch_context=fetch_context,
+                    trim_context=trim_context, offset_padding=offset_padding, exact_lengths=exact_lengths, coverage=coverage,
+                    max_covered=max_covered)
+
+def _checkpoint_files(checkpoint_dir):
+    """Return a dict of book uri to its checkpoint file name ({book}.{key}.jsonl) for every checkpoint in the directory"""
+    checkpoints = {}
+    for file_name in os.listdir(checkpoint_dir):
+        if file_name.endswith(".jsonl") and not file_name.endswith(".tmp.jsonl"):
+            book, key = file_name[:-len(".jsonl")].rsplit(".", 1)
+            checkpoints[book] = file_name
+    return checkpoints
+
+def query_corpus_checkpointed(cluster_obj, path_dict, checkpoint_dir, book_list = [], min_gap=12, fetch_context=False, trim_context=0,
+                              offset_padding=0, workers=None, ms_lengths=None, store_dir=None, coverage=None, max_covered=0):
+    """Run the gap search and fetch the gap texts for each book, writing the populated gaps of each book to a checkpoint
+    ({checkpoint_dir}/{book}.{key}.jsonl) as soon as the book is done. Books with a checkpoint for the current key
+    (see book_checkpoint_key) are not run again - so an interrupted run picks up where it stopped, and a run on a new
+    cluster release only recomputes the books whose clusters (or texts) changed
+    The checkpoints hold indexes starting from 1 for each book - they are offset when the books are merged, in book_list
+    order, so the 'index' values are the same as query_corpus
+    Returns: a list of dicts in the same format as query_corpus, with the texts populated (see populate_offset_text)"""
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+
+    # If no books are given, use every book in the cluster data
+    if len(book_list) == 0:
+        book_list = sorted(cluster_obj.cluster_df["book"].drop_duplicates().to_list())
+    book_order = list(dict.fromkeys(book_list))
+
+    # Find the books that do not have a valid checkpoint - the hashes of the texts are kept in the checkpoint_dir, so later
+    # runs only read the texts that have changed
+    print("Checking checkpoints")
+    existing = _checkpoint_files(checkpoint_dir)
+    hash_cache = contentHashCache(os.path.join(checkpoint_dir, "text_hashes.json"))
+    checkpoint_names = {}
+    for book_uri in tqdm(book_order):
+        key = book_checkpoint_key(cluster_obj, book_uri, path_dict, min_gap=min_gap, fetch_context=fetch_context, trim_context=trim_context,
+                                  offset_padding=offset_padding, exact_lengths=ms_lengths is not None, coverage=coverage,
+                                  max_covered=max_covered, hash_cache=hash_cache)
+        checkpoint_names[book_uri] = f"{book_uri}.{key}.jsonl"
+    hash_cache.save()
+    to_run = [book_uri for book_uri in book_order if existing.get(book_uri) != checkpoint_names[book_uri]]
+    print(f"{len(book_order) - len(to_run)} books have a valid checkpoint - running {len(to_run)} books")
+
+    # Query, populate (in batches of books) and checkpoint each book - iter_query_corpus offsets the indexes, so take them
+    # back to the book's own
+    if len(to_run) > 0:
+        index_start = 0
+        book_results = iter_query_corpus(cluster_obj, to_run, min_gap=min_gap, workers=workers, ms_lengths=ms_lengths,
+                                         coverage=coverage, max_covered=max_covered)
+        for book_uri, results in iter_populated_books(book_results, path_dict, offset_padding=offset_padding, fetch_context=fetch_context,
+                                                      trim_context=trim_context, store_dir=store_dir, workers=workers):
+            for row in results:
+                row["index"] -= index_start
+            index_start += len(results)
+            
+            # Write to a temporary file and rename, so an interrupted run never leaves a partial checkpoint
+            tmp_path = os.path.join(checkpoint_dir, f"{book_uri}.tmp.jsonl")
+            with gapsWriter(tmp_path) as writer:
+                writer.write_many(results)
+            os.replace(tmp_path, os.path.join(checkpoint_dir, checkpoint_names[book_uri]))
+            if book_uri in existing and existing[book_uri] != checkpoint_names[book_uri]:
+                os.remove(os.path.join(checkpoint_dir, existing[book_uri]))
+
+    # Merge the checkpoints in book order with a global index
+    out_data = []
+    for book_uri in book_order:
+        book_index_start = len(out_data)
+        for row in ndjsonGaps(os.path.join(checkpoint_dir, checkpoint_names[book_uri])):
+            row["index"] += book_index_start
+            out_data.append(row)
+    
+    return out_data
+
+def run_pipeline(cluster_path, meta_path, openiti_base_dir, book_list = [], raw_gaps_out=None, fetch_context=False, trim_context=0, offset_padding=0, workers=None, ms_lengths_dir=None, snapshot_dir=None, compact=False, store_dir=None, checkpoint_dir=None, min_gap=12, metrics_out=None, profile_dir=None, coverage=None, max_covered=0):
     """Run full processing pipeline from cluster data to data about gaps
     In:
     cluster_path: path to the cluster data (csv, json dir or parquet dir)
     meta_path: path to metadata, used by clusterDF
     book_list: a list of book_uris to use, if empty run whole corpus, if one book only data for one book
-    raw_gaps_out: a path to export a raw gaps json (produced by query_book or query_corpus)
+    raw_gaps_out: a path to export a raw gaps json (produced by query_book or query_corpus). If the path ends in .jsonl or
+    .ndjson the gaps are streamed to it book by book as newline-delimited json, so the full gap list is never held in memory
+    (the function then returns None)
+    If the path ends in .parquet the gaps are saved as a table of gap sides (see gapsClusters.save_parquet)
     offset_padding: add padding to the offsets to expand the captured material beyond that identified through passim, padding is given in
     characters and rounded to the nearest token during processing (to avoid mid-token breaks)
+    workers: number of processes used by query_corpus when running more than one book and to load the texts
+    ms_lengths_dir: a directory of milestone length tables (see utilities.msLengths). If given, any missing tables are built
+    before the gap search (from the store_dir for the books it holds) and gaps are measured with the real milestone lengths
+    snapshot_dir: a directory for clusterDf snapshots - repeated runs on the same cluster data load the cleaned clusters from there
+    compact: store the cluster data with compact dtypes (see clusterDf.compact_dtypes)
+    store_dir: a store of pre-cleaned texts built with utilities.cleanedStore.build_cleaned_store, used to fetch the gap text
+    checkpoint_dir: a directory for per-book checkpoints of the gaps (see query_corpus_checkpointed) - reruns skip the books
+    whose checkpoints are still valid
+    min_gap: the minimum gap in characters between two reuse instances (see query_book)
+    metrics_out: a path to write a json of the time, cpu and memory used by each stage of the run and counts of the data
+    processed (see utilities.instrumentation)
+    profile_dir: a directory to write cProfile stats for each of the main stages of the run ({profile_dir}/run_pipeline.{stage}.prof)
+    coverage: "annotate" or "filter" - check whether each gap is covered by another alignment with an earlier text (see query_book)
+    max_covered: the number of covered characters allowed in a gap when coverage="filter"
     """
 
-    # Create the cluster object
-    cluster_obj = clusterDf(cluster_path, meta_path)
+    # Record metrics for the run if asked to - the previous metrics object is restored at the end
+    run_metrics = None
+    if metrics_out or profile_dir:
+        run_metrics = pipelineMetrics(profile_dir=profile_dir, profile_stages=["cluster_data", "ms_lengths", "checkpointed_gaps", "streamed_gaps",
+                                                                             "gap_search", "populate_offset_text", "save_gaps"])
+        previous_metrics = set_metrics(run_metrics)
+    try:
+        with get_metrics().stage("run_pipeline"):
+            _run_pipeline_stages(cluster_path, meta_path, openiti_base_dir, book_list, raw_gaps_out, fetch_context, trim_context,
+                                 offset_padding, workers, ms_lengths_dir, snapshot_dir, compact, store_dir, checkpoint_dir, min_gap, coverage,
+                                 max_covered)
+    finally:
+        if run_metrics is not None:
+            set_metrics(previous_metrics)
+            run_metrics.report()
+            if metrics_out:
+                run_metrics.save(metrics_out)
+
+def _run_pipeline_stages(cluster_path, meta_path, openiti_base_dir, book_list, raw_gaps_out, fetch_context, trim_context, offset_padding,
+                         workers, ms_lengths_dir, snapshot_dir, compact, store_dir, checkpoint_dir, min_gap, coverage,
+                         max_covered):
+    """The stages of run_pipeline - see run_pipeline for the parameters"""
+    metrics = get_metrics()
 
-    # If we only have one book, just run query book
-    book_count = len(book_list)
-    if book_count == 1:
-        gap_data = query_book(cluster_obj, book_list[0])
-    
-    else:
-        gap_data = query_corpus(cluster_obj, book_list)
-    
-    # Use corpus to fetch text
+    # Create the cluster object
+    with metrics.stage("cluster_data"):
+        cluster_obj = clusterDf(cluster_path, meta_path, snapshot_dir=snapshot_dir, compact=compact)
 
     # Produce dict of file paths for books
     path_dict = create_path_dict(meta_path, openiti_base_dir)
 
-    # Add offsetted text pieces to the gap_data
-    gap_data = populate_offset_text(gap_data, path_dict, offset_padding=offset_padding, fetch_context=fetch_context, trim_context = trim_context)
+    # If using real milestone lengths - make sure every book in the cluster data has a table before searching
+    ms_lengths = None
+    if ms_lengths_dir:
+        with metrics.stage("ms_lengths"):
+            cluster_books = cluster_obj.cluster_df["book"].drop_duplicates().to_list()
+            ms_lengths = build_ms_length_tables(path_dict, ms_lengths_dir, book_list=cluster_books, workers=workers, store_dir=store_dir)
+
+    # If checkpointing - query and populate the books that do not have a valid checkpoint and merge the checkpoints
+    if checkpoint_dir:
+        with metrics.stage("checkpointed_gaps"):
+            gap_data = query_corpus_checkpointed(cluster_obj, path_dict, checkpoint_dir, book_list, min_gap=min_gap, fetch_context=fetch_context,
+                                                 trim_context=trim_context, offset_padding=offset_padding, workers=workers,
+                                                 ms_lengths=ms_lengths, store_dir=store_dir, coverage=coverage, max_covered=max_covered)
+
+    # Stream the gaps to newline-delimited json - the books are queried, populated with text in batches and written as they
+    # come
+    elif raw_gaps_out and raw_gaps_out.split(".")[-1] in ["jsonl", "ndjson"]:
+        with metrics.stage("streamed_gaps"):
+            with gapsWriter(raw_gaps_out) as writer:
+                book_results = iter_query_corpus(cluster_obj, book_list, min_gap=min_gap, workers=workers, ms_lengths=ms_lengths,
+                                                 coverage=coverage, max_covered=max_covered)
+                for book_uri, results in iter_populated_books(book_results, path_dict, offset_padding=offset_padding, fetch_context=fetch_context,
+                                                              trim_context=trim_context, store_dir=store_dir, workers=workers):
+                    writer.write_many(results)
+            metrics.count("bytes_written", os.path.getsize(raw_gaps_out))
+        print(f"{writer.records_written} gaps written to {raw_gaps_out}")
+        return None
+
+    else:
+        # If we only have one book, just run query book
+        with metrics.stage("gap_search"):
+            book_count = len(book_list)
+            if book_count == 1:
+                gap_data = query_book(cluster_obj, book_list[0], min_gap=min_gap, ms_lengths=ms_lengths, coverage=coverage,
+                                      max_covered=max_covered)
+            
+            else:
+                gap_data = query_corpus(cluster_obj, book_list, min_gap=min_gap, workers=workers, ms_lengths=ms_lengths, coverage=coverage,
+                                        max_covered=max_covered)
+        
+        # Use corpus to fetch text
+
+        # Add offsetted text pieces to the gap_data
+        with metrics.stage("populate_offset_text"):
+            gap_data = populate_offset_text(gap_data, path_dict, offset_padding=offset_padding, fetch_context=fetch_context, trim_context = trim_context, store_dir=store_dir, workers=workers)
     
     # Store the data as a gapsCluster object for later processing steps
     gaps_obj = gapsClusters(gap_data)
-    # Export a json of the gap_data if the path is given
-    if raw_gaps_out:
+    # Export a json (or a parquet table of gap sides, or newline-delimited json) of the gap_data if the path is given
+    if raw_gaps_out and raw_gaps_out.split(".")[-1] == "parquet":
+        gaps_obj.save_parquet(raw_gaps_out)
+    elif raw_gaps_out and raw_gaps_out.split(".")[-1] in ["jsonl", "ndjson"]:
+        gaps_obj.save_ndjson(raw_gaps_out)
+    elif raw_gaps_out:
         gaps_obj.save_json(raw_gaps_out)
 
         
 
-
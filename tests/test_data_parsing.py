@@ -0,0 +1,26 @@
+from utilities.data_parsing import gapsClusters
+
+
+def gap(book, ms):
+    return {"book": book, "start": {"ms": ms, "ch": 0}, "end": {"ms": ms, "ch": 10}, "text": f"{book} {ms}"}
+
+def record(index, primary_book, other_books):
+    return {"index": index, "gaps_data": [gap(primary_book, index)] + [gap(book, index) for book in other_books],
+            "books": other_books + [primary_book]}
+
+def test_load_parquet_books_with_repeated_indexes(tmp_path):
+    # Indexes restart for each primary book - as in appended single book runs
+    gaps_data = [record(1, "0300A.Book", ["0200B.Book"]),
+                 record(2, "0300A.Book", ["0100C.Book"]),
+                 record(1, "0400D.Book", ["0100C.Book"]),
+                 record(2, "0400D.Book", ["0200B.Book", "0100C.Book"])]
+    path = str(tmp_path / "gaps.parquet")
+    gapsClusters(gaps_data).save_parquet(path)
+
+    loaded = gapsClusters(path, books=["0200B.Book"]).gaps_dict
+    assert loaded == [gaps_data[0], gaps_data[3]]
+
+    loaded = gapsClusters(path, books=["0100C.Book"], primary_books=["0300A.Book"]).gaps_dict
+    assert loaded == [gaps_data[1]]
+
+    assert gapsClusters(path, books=["0500E.Book"]).gaps_dict == []
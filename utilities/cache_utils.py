@@ -0,0 +1,80 @@
+"""Helper functions for the on-disk caches used across the pipelines - fingerprints of input files and keys built from
+the parameters of a run, so a cached output is only reused when its inputs and settings have not changed"""
+import hashlib
+import json
+import os
+import pandas as pd
+
+
+def fingerprint_path(path):
+    """Return a fingerprint of a file or of every file in a directory, built from the file names, sizes and modification
+    times (the contents are not read, so this is cheap even for multi-GB cluster dumps)"""
+    if os.path.isdir(path):
+        entries = []
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                full_path = os.path.join(root, name)
+                stat = os.stat(full_path)
+                entries.append([os.path.relpath(full_path, path), stat.st_size, stat.st_mtime_ns])
+        entries.sort()
+    else:
+        stat = os.stat(path)
+        entries = [os.path.basename(path), stat.st_size, stat.st_mtime_ns]
+    return hash_key(entries)
+
+
+def hash_file(path, chunk_size=2**20):
+    """Hash the contents of a file into a short hex key, reading it in chunks"""
+    file_hash = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()[:16]
+
+
+class contentHashCache():
+    """Content hashes of files (see hash_file), kept with the size and modification time of each file when it was hashed.
+    A file is only read again if its size or modification time has changed, and a copy, fresh checkout or touch of an
+    unchanged file still gives the same hash
+    cache_path: a json file to keep the hashes in between runs - if None the hashes are only kept in memory"""
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.hashes = {}
+        self._changed = False
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, "r", encoding="utf-8") as f:
+                self.hashes = json.load(f)
+
+    def get(self, path):
+        """Return the content hash of a file"""
+        stat = os.stat(path)
+        abs_path = os.path.abspath(path)
+        entry = self.hashes.get(abs_path)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": hash_file(path)}
+            self.hashes[abs_path] = entry
+            self._changed = True
+        return entry["hash"]
+
+    def save(self):
+        """Write the hashes to cache_path if any were added"""
+        if self.cache_path is None or not self._changed:
+            return
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.hashes, f)
+        os.replace(tmp_path, self.cache_path)
+        self._changed = False
+
+
+def hash_key(*args, **kwargs):
+    """Hash any json-serialisable arguments into a short hex key - keyword arguments are sorted so their order does not matter"""
+    key_string = json.dumps([args, kwargs], sort_keys=True, default=str)
+    return hashlib.sha1(key_string.encode("utf-8")).hexdigest()[:16]
+
+
+def hash_frame(df):
+    """Hash the values of a dataframe into a short hex key (the index is ignored) - used to tell whether the cluster rows
+    behind a cached result have changed"""
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return hashlib.sha1(row_hashes.tobytes()).hexdigest()[:16]
@@ -0,0 +1,147 @@
+"""A persistent store of pre-cleaned OpenITI texts. The cleaned text that passim offsets refer to does not change within a
+corpus release, so each book is cleaned once (build_cleaned_store) and written as:
+{book}.txt - the cleaned milestones concatenated into one utf-8 buffer
+{book}.npy - an int64 array of shape (n, 4): milestone number, start byte, end byte and cleaned length in characters
+{book}.json - the zfill of the milestone markers in the original text
+storedTextMs reads milestones from the store through a memory-map, with the same fetch methods as openitiTextMs"""
+from utilities.openitiTexts import openitiTextMs
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import json
+import mmap
+import os
+from tqdm import tqdm
+
+
+class storedTextMs(openitiTextMs):
+    """An openitiTextMs that reads the cleaned milestones of a book from a store built by build_cleaned_store, rather than
+    reading and cleaning the OpenITI text. Only cleaned text is held in the store - fetch_milestone(clean=False) is not available"""
+    def __init__(self, store_dir, book, report=False):
+        self.ms_pattern = r"ms\d+"
+        self.lazy = True
+        self.book = book
+
+        table_path = os.path.join(store_dir, f"{book}.npy")
+        if not os.path.exists(table_path):
+            raise FileNotFoundError(f"Book {book} is not in the store {store_dir}")
+
+        # Memory-map the offsets and the text buffer - slices are decoded directly from the map
+        self.ms_table = np.load(table_path, mmap_mode="r")
+        with open(os.path.join(store_dir, f"{book}.txt"), "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(f.name) > 0 else b""
+        with open(os.path.join(store_dir, f"{book}.json"), "r", encoding="utf-8") as f:
+            self.zfill_len = json.load(f)["zfill"]
+
+        self.ms_numbers = np.array(self.ms_table[:, 0])
+        self.ms_total = len(self.ms_numbers)
+
+        # The cleaned text is never recomputed, so there is nothing to cache
+        self.clean_cache = {}
+        self.clean_cache_size = 0
+        self.clean_cache_hits = 0
+        self.clean_cache_misses = 0
+
+        # Milestones read from the store - counted apart from clean_cache_misses, as nothing is cleaned
+        self.store_reads = 0
+
+        if report:
+            self.report_stats()
+
+    def list_milestones(self):
+        return self.ms_numbers.tolist()
+
+    def ms_lengths(self):
+        """Return the milestone numbers and the cleaned length of each milestone"""
+        return self.ms_numbers, np.array(self.ms_table[:, 3])
+
+    def read_ms_text(self, number):
+        raise ValueError("Only cleaned text is held in the store - use fetch_milestone(number, clean=True)")
+
+    def fetch_clean_milestone(self, number):
+        """Decode the cleaned milestone directly from the memory-mapped buffer"""
+        idx = np.searchsorted(self.ms_numbers, number)
+        if idx == len(self.ms_numbers) or self.ms_numbers[idx] != number:
+            raise KeyError(number)
+        start, end = self.ms_table[idx, 1], self.ms_table[idx, 2]
+        self.store_reads += 1
+        with memoryview(self.buffer) as view, view[start:end] as ms_view:
+            return str(ms_view, "utf-8")
+
+    def close(self):
+        """Release the memory-maps of the text buffer and the milestone table"""
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.ms_table = None
+
+
+class cleanedCorpusStore():
+    """A directory of cleaned books written by build_cleaned_store"""
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def __contains__(self, book):
+        return os.path.exists(os.path.join(self.store_dir, f"{book}.npy"))
+
+    def open_book(self, book):
+        return storedTextMs(self.store_dir, book)
+
+
+def write_cleaned_book(book, openiti_path, store_dir):
+    """Clean every milestone of an OpenITI text and write the book to the store"""
+    ms_obj = openitiTextMs(openiti_path, lazy=True, clean_cache_size=0)
+    ms_numbers = ms_obj.list_milestones()
+    table = np.zeros((len(ms_numbers), 4), dtype=np.int64)
+
+    # Write to temporary files and rename at the end, so an interrupted job never leaves a partial book in the store
+    tmp_paths = {ext: os.path.join(store_dir, f"{book}.tmp.{ext}") for ext in ["txt", "npy", "json"]}
+    position = 0
+    with open(tmp_paths["txt"], "wb") as f:
+        for idx, ms_number in enumerate(ms_numbers):
+            text = ms_obj.fetch_milestone(ms_number, clean=True)
+            encoded = text.encode("utf-8")
+            f.write(encoded)
+            table[idx] = [ms_number, position, position + len(encoded), len(text)]
+            position += len(encoded)
+    ms_obj.close()
+    np.save(tmp_paths["npy"], table)
+    with open(tmp_paths["json"], "w", encoding="utf-8") as f:
+        json.dump({"zfill": ms_obj.zfill_len}, f)
+
+    # Move the table last - its presence is what marks the book as being in the store
+    for ext in ["txt", "json", "npy"]:
+        os.replace(tmp_paths[ext], os.path.join(store_dir, f"{book}.{ext}"))
+    return book
+
+
+def build_cleaned_store(path_dict, store_dir, book_list=None, workers=None, overwrite=False):
+    """One-off job to clean a corpus into the store across a pool of processes
+    path_dict: dict of book uri to the path of the OpenITI text (produced by create_path_dict)
+    store_dir: directory for the store
+    book_list: only store these books, if None store every book in path_dict
+    workers: number of processes to use - defaults to the number of cpus
+    overwrite: if False, books already in the store are skipped
+    Returns: a cleanedCorpusStore for the store_dir"""
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    store = cleanedCorpusStore(store_dir)
+
+    if book_list is None:
+        book_list = list(path_dict.keys())
+    to_build = [book for book in book_list if book in path_dict and (overwrite or book not in store)]
+
+    print(f"Writing {len(to_build)} cleaned books to the store")
+    if len(to_build) > 0:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(write_cleaned_book, book, path_dict[book], store_dir) for book in to_build]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                future.result()
+
+    return store
+
+
+if __name__ == "__main__":
+    from find_shared_gaps.find_shared_gaps import create_path_dict
+    meta_path = "E:/Corpus Stats/2023/OpenITI_metadata_2023-1-8.csv"
+    openiti_base_dir = "E:/OpenITI Corpus/corpus_2023_1_8"
+    store_dir = "E:/OpenITI Corpus/corpus_2023_1_8_cleaned"
+    build_cleaned_store(create_path_dict(meta_path, openiti_base_dir), store_dir)
@@ -1,16 +1,229 @@
 from utilities.load_all_cls import load_all_cls
+from utilities.cache_utils import fingerprint_path, hash_key
+from utilities.instrumentation import get_metrics
+from collections import OrderedDict
 import pandas as pd
+import numpy as np
+import pyarrow.feather as feather
 import re
 import os
 
 """Note this has been refactored to allow easier date filtering when fetching book and ms specific clusters using the fetch_df function
-larger refactor of this code is needed to adopt a pipeline type approach (build a series of cluster filters and then apply them would be more flexible)"""
+Filters can be combined with apply_filters, which builds one mask from a series of filters and cleans the single clusters once at the end.
+Each filter_by_ function can also be run with clean=False and followed by a single call to clean_single_clusters"""
 
 class clusterDf():
-    def __init__ (self, cluster_path, meta_path, min_date=0, max_date = 1500, cluster_cap = 500, drop_strings = True, columns = ["uid", "gid", "cluster", "size", "seq", "series", "text", "begin", "end"]):
-        self.cluster_df = load_all_cls(cluster_path, meta_path, drop_strings=drop_strings, columns = columns, drop_dates=False, max_date = max_date, min_date=min_date, cluster_cap = cluster_cap)
-        self.cluster_df = self.clean_single_clusters(self.cluster_df)
+    def __init__ (self, cluster_path, meta_path, min_date=0, max_date = 1500, cluster_cap = 500, drop_strings = True, columns = ["uid", "gid", "cluster", "size", "seq", "series", "text", "begin", "end"], snapshot_dir=None, compact=False,
+                  date_view_cache_size=64):
+        """snapshot_dir: if given, the loaded and cleaned cluster table is saved there as an uncompressed feather file, keyed by
+        the fingerprints of the input files and the loading parameters. Later runs with the same inputs and parameters
+        memory-map the snapshot instead of re-reading and re-cleaning the clusters
+        compact: if True, store the uri columns as categoricals and downcast the numeric columns (see compact_dtypes)
+        date_view_cache_size: the number of date ranges to keep the surviving clusters of (see fetch_date_view)
+        The reuse matrix (see fetch_reuse_matrix) is also cached in the snapshot_dir, next to the snapshot of the same data"""
+        self.date_view_cache_size = date_view_cache_size
+        snapshot_path = None
+        if snapshot_dir is not None:
+            snapshot_path = self.snapshot_path(snapshot_dir, cluster_path, meta_path, min_date=min_date, max_date=max_date,
+                                               cluster_cap=cluster_cap, drop_strings=drop_strings, columns=columns, compact=compact)
+        
+        metrics = get_metrics()
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            print(f"Loading cluster snapshot: {snapshot_path}")
+            with metrics.stage("load_snapshot"):
+                self.cluster_df = feather.read_table(snapshot_path, memory_map=True).to_pandas(split_blocks=True)
+        else:
+            with metrics.stage("load_clusters"):
+                self.cluster_df = load_all_cls(cluster_path, meta_path, drop_strings=drop_strings, columns = columns, drop_dates=False, max_date = max_date, min_date=min_date, cluster_cap = cluster_cap)
+                metrics.count("cluster_rows_loaded", len(self.cluster_df))
+            with metrics.stage("clean_single_clusters"):
+                self.cluster_df = self.clean_single_clusters(self.cluster_df).reset_index(drop=True)
+            if compact:
+                self.cluster_df = self.compact_dtypes(self.cluster_df)
+            if snapshot_path is not None:
+                self.write_snapshot(snapshot_path)
+        # The snapshot identifies the loaded data for the caches built from it - any change to the data clears it
+        self.source_snapshot = snapshot_path
+        metrics.count("cluster_rows", len(self.cluster_df))
+        with metrics.stage("build_cluster_index"):
+            self.build_cluster_index()
         self.print_aggregated_stats()
+    
+    def snapshot_path(self, snapshot_dir, cluster_path, meta_path, **params):
+        """Build the path of the snapshot for a set of input files and loading parameters"""
+        key = hash_key(fingerprint_path(cluster_path), fingerprint_path(meta_path), **params)
+        return os.path.join(snapshot_dir, f"clusters_{key}.feather")
+
+    def write_snapshot(self, snapshot_path):
+        """Write self.cluster_df as an uncompressed feather file (so it can be memory-mapped when loaded)"""
+        snapshot_dir = os.path.dirname(snapshot_path)
+        if snapshot_dir and not os.path.exists(snapshot_dir):
+            os.makedirs(snapshot_dir)
+        print(f"Writing cluster snapshot: {snapshot_path}")
+        tmp_path = snapshot_path + ".tmp"
+        feather.write_feather(self.cluster_df.reset_index(drop=True), tmp_path, compression="uncompressed")
+        os.replace(tmp_path, snapshot_path)
+
+    def compact_dtypes(self, cl_df, category_columns = ["book", "series", "id"]):
+        """Reduce the memory footprint of a cluster df: uri columns are stored as categoricals (each distinct uri is stored once
+        with an integer code per row) and every integer column is downcast to the smallest type that holds its values"""
+        cl_df = cl_df.copy()
+        for column in cl_df.columns:
+            if column in category_columns:
+                cl_df[column] = cl_df[column].astype("category")
+            elif pd.api.types.is_integer_dtype(cl_df[column]):
+                cl_df[column] = pd.to_numeric(cl_df[column], downcast="integer")
+        return cl_df
+
+    def memory_report(self, df_in = None):
+        """Return a df giving the dtype and the bytes used by each column of the cluster df (including the contents of string
+        columns), with a total row at the end"""
+        if df_in is None:
+            df_in = self.cluster_df
+        bytes_used = df_in.memory_usage(deep=True, index=True)
+        report = pd.DataFrame({"column": bytes_used.index.astype(str),
+                               "dtype": ["index"] + [str(dtype) for dtype in df_in.dtypes],
+                               "bytes": bytes_used.to_numpy()})
+        total = pd.DataFrame([{"column": "total", "dtype": "", "bytes": report["bytes"].sum()}])
+        return pd.concat([report, total], ignore_index=True)
+
+    @property
+    def cluster_df(self):
+        return self._cluster_df
+    
+    @cluster_df.setter
+    def cluster_df(self, cl_df):
+        """Any change to the cluster data invalidates the membership index - it is rebuilt the next time it is needed"""
+        self._cluster_df = cl_df
+        self._cluster_index = None
+        self._date_index = None
+        self._date_views = OrderedDict()
+        self._reuse_matrix = None
+        self._reuse_ranges = {}
+        self.source_snapshot = None
+
+    def build_cluster_index(self):
+        """Build a CSR-style index of self.cluster_df so that all of the rows for a cluster or for a book can be fetched as a
+        slice, rather than scanning the whole df. Positions are row positions (for use with iloc), stored sorted by cluster
+        (and by book), with offset arrays giving the start and end of each cluster's (or book's) slice. Stable sorts keep the
+        positions within each slice in the original row order"""
+        cluster_values = self._cluster_df["cluster"].to_numpy()
+        cluster_order = np.argsort(cluster_values, kind="stable")
+        cluster_ids, cluster_starts = np.unique(cluster_values[cluster_order], return_index=True)
+        cluster_offsets = np.append(cluster_starts, len(cluster_values))
+
+        book_codes, books = pd.factorize(self._cluster_df["book"])
+        book_order = np.argsort(book_codes, kind="stable")
+        book_offsets = np.concatenate([[0], np.cumsum(np.bincount(book_codes, minlength=len(books)))])
+        book_ranges = {book: (book_offsets[idx], book_offsets[idx+1]) for idx, book in enumerate(books)}
+
+        self._cluster_index = {"cluster_order": cluster_order, "cluster_ids": cluster_ids, "cluster_offsets": cluster_offsets,
+                               "book_order": book_order, "book_ranges": book_ranges}
+
+    def _get_cluster_index(self):
+        if self._cluster_index is None:
+            self.build_cluster_index()
+        return self._cluster_index
+
+    def fetch_book_positions(self, book):
+        """Return the row positions of all of the rows of a book (in original row order) using the index"""
+        index = self._get_cluster_index()
+        start, end = index["book_ranges"].get(book, (0, 0))
+        return index["book_order"][start:end]
+
+    def build_date_index(self):
+        """Build an index of the dates of the members of each cluster, so that the number of members of every cluster in a
+        date range can be counted without a groupby. Each row is given the position of its cluster in the cluster index and
+        the rank of its date among the distinct dates. The rows are ordered by cluster and then date, as (cluster, date rank)
+        keys - the members of a cluster up to a date are then a searchsorted away from the start of the cluster's slice"""
+        index = self._get_cluster_index()
+        row_clusters = np.searchsorted(index["cluster_ids"], self._cluster_df["cluster"].to_numpy())
+        date_values, date_ranks = np.unique(self._cluster_df["date"].to_numpy(), return_inverse=True)
+        span = len(date_values) + 1
+        date_keys = np.sort(row_clusters.astype(np.int64) * span + date_ranks)
+        self._date_index = {"row_clusters": row_clusters, "date_values": date_values, "span": span, "date_keys": date_keys}
+
+    def _get_date_index(self):
+        if self._date_index is None:
+            self.build_date_index()
+        return self._date_index
+
+    def count_cluster_members_in_dates(self, min_date, max_date, clusters=None):
+        """Return an array of the number of rows of each cluster dated from min_date to max_date (inclusive)
+        clusters: positions in the cluster index of the clusters to count - if None, count every cluster (in the order
+        of the cluster index)"""
+        date_index = self._get_date_index()
+        date_values, span, date_keys = date_index["date_values"], date_index["span"], date_index["date_keys"]
+        if clusters is None:
+            clusters = np.arange(len(self._get_cluster_index()["cluster_ids"]), dtype=np.int64)
+
+        # Rows in the range have a date rank from the first date >= min_date to the last date <= max_date
+        first_rank = np.searchsorted(date_values, min_date, side="left")
+        last_rank = np.searchsorted(date_values, max_date, side="right")
+        cluster_keys = np.asarray(clusters, dtype=np.int64) * span
+        return np.searchsorted(date_keys, cluster_keys + last_rank) - np.searchsorted(date_keys, cluster_keys + first_rank)
+
+    def fetch_date_view(self, min_date, max_date, clusters):
+        """Return a boolean array (in the order of clusters) - true for the clusters that keep more than one row when
+        filtered to the date range, so they would survive clean_single_clusters.
+        clusters: positions in the cluster index of the clusters to check
+        Many books share the same death date, so for the most recent date ranges (up to date_view_cache_size) the clusters
+        checked so far are cached, and only the clusters not seen before with that range are counted"""
+        clusters = np.asarray(clusters, dtype=np.int64)
+        key = (min_date, max_date)
+        if key in self._date_views:
+            self._date_views.move_to_end(key)
+        else:
+            get_metrics().count("date_views_built")
+            self._date_views[key] = (np.empty(0, dtype=np.int64), np.empty(0, dtype=bool))
+            if len(self._date_views) > self.date_view_cache_size:
+                self._date_views.popitem(last=False)
+        known, surviving = self._date_views[key]
+
+        # Count the members of the clusters not yet checked with this range and merge them into the cached view
+        idx = np.searchsorted(known, clusters)
+        found = idx < len(known)
+        found[found] = known[idx[found]] == clusters[found]
+        if not found.all():
+            missing = np.unique(clusters[~found])
+            get_metrics().count("date_view_clusters_counted", len(missing))
+            known = np.concatenate([known, missing])
+            surviving = np.concatenate([surviving, self.count_cluster_members_in_dates(min_date, max_date, missing) > 1])
+            order = np.argsort(known, kind="stable")
+            known, surviving = known[order], surviving[order]
+            self._date_views[key] = (known, surviving)
+            idx = np.searchsorted(known, clusters)
+        return surviving[idx]
+
+    def filter_positions_by_date(self, positions, min_date, max_date):
+        """Filter row positions to the rows dated from min_date to max_date, dropping the rows of clusters left with a single
+        row. Gives the same rows as filter_by_date_range on the rows of whole clusters (e.g. from fetch_cluster_positions),
+        using the cached date view rather than re-cleaning the single clusters"""
+        dates = self._cluster_df["date"].to_numpy()[positions]
+        in_range = (dates >= min_date) & (dates <= max_date)
+        row_clusters = self._get_date_index()["row_clusters"][positions]
+        surviving = self.fetch_date_view(min_date, max_date, row_clusters)
+        return positions[in_range & surviving]
+
+    def fetch_cluster_positions(self, clusters):
+        """Return the row positions of all of the rows belonging to any of the given clusters, in original row order
+        (so that iloc with the result matches filtering with isin)"""
+        index = self._get_cluster_index()
+        cluster_ids = index["cluster_ids"]
+        clusters = np.unique(np.asarray(clusters))
+        
+        # Find the slice for each requested cluster - drop any clusters that are not in the index
+        idx = np.searchsorted(cluster_ids, clusters)
+        in_range = idx < len(cluster_ids)
+        idx, clusters = idx[in_range], clusters[in_range]
+        idx = idx[cluster_ids[idx] == clusters]
+        starts = index["cluster_offsets"][idx]
+        lengths = index["cluster_offsets"][idx + 1] - starts
+
+        # Concatenate the slices without a python loop, then restore the original row order
+        slice_offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        positions = index["cluster_order"][slice_offsets + np.arange(lengths.sum())]
+        return np.sort(positions)
         
 
     def clean_single_clusters(self, cl_df):
@@ -18,7 +231,8 @@ class clusterDf():
           filtered by date 845 will be left with only one item in the cluster. This creates problems downstream
           All filtering processes need to be passed to this function"""
         print("Cleaning up the single clusters")
-        return cl_df.groupby("cluster").filter(lambda x: len(x) > 1)
+        # A cluster with more than one row has every one of its rows marked as duplicated
+        return cl_df[cl_df["cluster"].duplicated(keep=False)]
         # new_cl_df = pd.DataFrame()
         # cluster_list = cl_df["cluster"].drop_duplicates().to_list()
         # for cluster in tqdm(cluster_list):
@@ -41,26 +255,162 @@ class clusterDf():
         rows of the cluster - it will need to be reduced to a single row for any aggregate stats on the cluster"""
         return self.cluster_df[self.cluster_df["size"] == self.cluster_df["size"].max()]
 
+    def build_reuse_matrix(self, max_pairs=5_000_000):
+        """Build a sparse book x book matrix of reuse from cluster co-membership with vectorised passes, as a COO style df with a
+        row for each pair of books that share at least one cluster:
+        book, other: the book and a book that shares clusters with it
+        instances: the number of rows of other in the clusters that contain book
+        length: the total aligned characters (end - begin) of those rows
+        other_date: the date of other
+        Rows are sorted by book and then other. The counts are the same as calculate_reuse_stats for every book at once
+        max_pairs: the member pairs are built for runs of clusters with up to this many pairs at a time (a single larger
+        cluster is built on its own), as the pairs grow with the square of the cluster size"""
+        cl_df = self.cluster_df
+        columns = ["book", "other", "instances", "length", "other_date"]
+        if len(cl_df) == 0:
+            return pd.DataFrame(columns=columns)
+        row_clusters = np.searchsorted(self._get_cluster_index()["cluster_ids"], cl_df["cluster"].to_numpy()).astype(np.int64)
+        book_codes, books = pd.factorize(cl_df["book"], sort=True)
+        books = np.asarray(books, dtype=object)
+        n_books = len(books)
+        row_lengths = cl_df["end"].to_numpy().astype(np.int64) - cl_df["begin"].to_numpy()
+
+        # Count the rows and aligned characters of each book in each cluster - members are sorted by cluster then book
+        member_keys, member_idx = np.unique(row_clusters * n_books + book_codes, return_inverse=True)
+        member_rows = np.bincount(member_idx)
+        member_chars = np.bincount(member_idx, weights=row_lengths)
+        member_clusters = member_keys // n_books
+        member_books = member_keys % n_books
+
+        # Pair every member of a cluster with every other member of the same cluster - each cluster is a contiguous run of
+        # members, so the pairs are built and summed for a run of clusters at a time
+        cluster_sizes = np.bincount(member_clusters)
+        cluster_starts = np.concatenate([[0], np.cumsum(cluster_sizes)])
+        cum_pairs = np.cumsum(cluster_sizes.astype(np.int64) ** 2)
+        chunk_keys, chunk_rows, chunk_chars = [], [], []
+        first = 0
+        while first < len(cluster_sizes):
+            done = cum_pairs[first - 1] if first > 0 else 0
+            last = max(int(np.searchsorted(cum_pairs, done + max_pairs, side="right")), first + 1)
+            members = np.arange(cluster_starts[first], cluster_starts[last])
+            pair_counts = cluster_sizes[member_clusters[members]]
+            pair_offsets = np.concatenate([[0], np.cumsum(pair_counts)[:-1]])
+            left = np.repeat(members, pair_counts)
+            right = np.repeat(cluster_starts[member_clusters[members]] - pair_offsets, pair_counts) + np.arange(pair_counts.sum())
+            left, right = left[left != right], right[left != right]
+
+            # Sum the members of the other book over the shared clusters of this run
+            keys, idx = np.unique(member_books[left] * n_books + member_books[right], return_inverse=True)
+            chunk_keys.append(keys)
+            chunk_rows.append(np.bincount(idx, weights=member_rows[right], minlength=len(keys)))
+            chunk_chars.append(np.bincount(idx, weights=member_chars[right], minlength=len(keys)))
+            first = last
+
+        # Combine the sums of the runs
+        pair_keys, pair_idx = np.unique(np.concatenate(chunk_keys), return_inverse=True)
+        book_dates = np.zeros(n_books, dtype=cl_df["date"].to_numpy().dtype)
+        book_dates[book_codes] = cl_df["date"].to_numpy()
+        other = pair_keys % n_books
+        return pd.DataFrame({
+            "book": books[pair_keys // n_books],
+            "other": books[other],
+            "instances": np.bincount(pair_idx, weights=np.concatenate(chunk_rows), minlength=len(pair_keys)).astype(np.int64),
+            "length": np.bincount(pair_idx, weights=np.concatenate(chunk_chars), minlength=len(pair_keys)).astype(np.int64),
+            "other_date": book_dates[other]})
+
+    def reuse_matrix_cache_path(self):
+        """Return the path of the parquet cache of the reuse matrix (next to the snapshot the data was loaded from), or None
+        if the data was not loaded from a snapshot"""
+        if self.source_snapshot is None:
+            return None
+        snapshot_name = os.path.basename(self.source_snapshot)
+        return os.path.join(os.path.dirname(self.source_snapshot),
+                            "reuse_" + snapshot_name[len("clusters_"):-len(".feather")] + ".parquet")
+
+    def fetch_reuse_matrix(self):
+        """Return the reuse matrix (see build_reuse_matrix) - it is built once and kept in memory. If the data was loaded with
+        a snapshot_dir (and has not been changed since) the matrix is also cached there as parquet, so later runs on the same
+        data read it rather than rebuilding it"""
+        if self._reuse_matrix is None:
+            cache_path = self.reuse_matrix_cache_path()
+            if cache_path is not None and os.path.exists(cache_path):
+                matrix = pd.read_parquet(cache_path)
+            else:
+                with get_metrics().stage("build_reuse_matrix"):
+                    matrix = self.build_reuse_matrix()
+                if cache_path is not None:
+                    tmp_path = cache_path + ".tmp"
+                    matrix.to_parquet(tmp_path, index=False)
+                    os.replace(tmp_path, cache_path)
+
+            # Each book's row of the matrix is a contiguous slice
+            book_values = matrix["book"].to_numpy()
+            starts = np.concatenate([[0], np.flatnonzero(book_values[1:] != book_values[:-1]) + 1]) if len(matrix) > 0 else np.array([], dtype=np.int64)
+            ends = np.append(starts[1:], len(matrix))
+            self._reuse_ranges = {book: (start, end) for book, start, end in zip(book_values[starts], starts, ends)}
+            self._reuse_matrix = matrix
+        return self._reuse_matrix
+
+    def has_reuse_matrix(self):
+        """Return True if the reuse matrix has already been built (or loaded) for the current data"""
+        return self._reuse_matrix is not None
+
+    def reuse_matrix_available(self):
+        """Return True if the reuse matrix is built or can be read from its cache, rather than having to be built"""
+        cache_path = self.reuse_matrix_cache_path()
+        return self.has_reuse_matrix() or (cache_path is not None and os.path.exists(cache_path))
+
+    def fetch_reuse_row(self, uri):
+        """Return the row of the reuse matrix for a book - a df with a row for each book it shares clusters with"""
+        matrix = self.fetch_reuse_matrix()
+        start, end = self._reuse_ranges.get(uri, (0, 0))
+        return matrix.iloc[start:end]
+
+    def shares_clusters(self, uri, max_date=None):
+        """Return True if the book shares a cluster with any other book - only counting books dated up to max_date if given"""
+        row = self.fetch_reuse_row(uri)
+        if max_date is not None:
+            return bool((row["other_date"].to_numpy() <= max_date).any())
+        return len(row) > 0
+
     def fetch_top_reusers(self, uri, uri_field="book", by = "length", exclude_self_reuse = False, dir = "bi", csv_out=None):
+        """Return a df of the books that share clusters with the uri, with the number of instances and the aligned length,
+        sorted by the by column (ties in uri order)
+        dir: "bi" for every book, "anachron" for the books dated before the uri death date and "chron" for those after
+        exclude_self_reuse: drop the other books of the same author
+        Books (uri_field="book") are looked up in the reuse matrix (see fetch_reuse_matrix), other fields are counted from the
+        cluster rows"""
         # Set up pre-requisites to be used by other funcs
         self.exclude_self_reuse = exclude_self_reuse
-        
-        # Find death date of author and determine whether to filter before or after
+
         if dir != "bi":
-            uri_death_date = int(re.findall("\d+", uri)[0])
+            uri_death_date = int(re.findall(r"\d+", uri)[0])
             print(uri_death_date)
+
+        if uri_field == "book":
+            stats_df = self.fetch_reuse_row(uri)
             if dir == "anachron":
-                df_in = self.cluster_df[self.cluster_df["date"] < uri_death_date]
+                stats_df = stats_df[stats_df["other_date"] < uri_death_date]
             elif dir == "chron":
-                df_in = self.cluster_df[self.cluster_df["date"] > uri_death_date]
+                stats_df = stats_df[stats_df["other_date"] > uri_death_date]
+            if exclude_self_reuse:
+                stats_df = stats_df[stats_df["other"].str.split(".").str[0] != uri.split(".")[0]]
+            stats_df = stats_df.rename(columns={"other": "uri"})[["uri", "length", "instances"]].reset_index(drop=True)
         else:
-            df_in = self.cluster_df
-        
-        # Send filtered df to the calcuate function
-        stats_df = self.calculate_reuse_stats(uri, uri_field=uri_field, df_in = df_in) 
+            # Only the clusters containing the uri are needed - fetch them through the index before applying the date filter
+            df_in = self.cluster_df.iloc[self.fetch_cluster_positions(self.fetch_clusters_by_uri(uri, uri_field=uri_field))]
+
+            # Filter before or after the death date of the author
+            if dir == "anachron":
+                df_in = df_in[df_in["date"] < uri_death_date]
+            elif dir == "chron":
+                df_in = df_in[df_in["date"] > uri_death_date]
+
+            # Send filtered df to the calcuate function
+            stats_df = self.calculate_reuse_stats(uri, uri_field=uri_field, df_in = df_in)
 
         # Sort and return df
-        stats_df = stats_df.sort_values(by=by, ascending=False)
+        stats_df = stats_df.sort_values(by=by, ascending=False, kind="stable")
 
         if csv_out:
             stats_df.to_csv(csv_out, index=False)
@@ -72,6 +422,10 @@ class clusterDf():
 
         cluster_df = self.cluster_df
 
+        # Book URIs are looked up through the index, other fields fall back to a scan
+        if uri_field == "book":
+            return cluster_df["cluster"].to_numpy()[self.fetch_book_positions(uri)].tolist()
+
         return cluster_df[cluster_df[uri_field] == uri]["cluster"].to_list()
     
     # Use a URI and a ms_list to fetch cluster list
@@ -79,72 +433,105 @@ class clusterDf():
 
         cluster_df = self.cluster_df
 
-        filtered = cluster_df[cluster_df[uri_field] == uri]
+        if uri_field == "book":
+            filtered = cluster_df.iloc[self.fetch_book_positions(uri)]
+        else:
+            filtered = cluster_df[cluster_df[uri_field] == uri]
         return filtered[filtered["seq"].isin(ms_list)]["cluster"].to_list()
 
     # Concatenate the uris in a cluster set
     def calculate_reuse_stats(self, uri, uri_field="book", df_in = None):
+        """Count the instances and aligned length of each book in the clusters of the uri (sorted by book). For whole books,
+        fetch_reuse_row gives the same counts from the reuse matrix"""
         cluster_list = self.fetch_clusters_by_uri(uri, uri_field=uri_field)        
         
         if df_in is None:
-            df_in = self.cluster_df
-        
-        df_in = df_in[df_in["cluster"].isin(cluster_list)]    
-        print(df_in)
-        if self.exclude_self_reuse:
-            
-            df_in["author"] = df_in["book"].str.split(".", expand=True)[0]
+            df_in = self.cluster_df.iloc[self.fetch_cluster_positions(cluster_list)]
+        else:
+            df_in = df_in[df_in["cluster"].isin(cluster_list)]    
+        if getattr(self, "exclude_self_reuse", False):
             uri_author = uri.split(".")[0]
-            df_in = df_in[df_in["author"] != uri_author]
-        
-        uri_list = df_in["book"].drop_duplicates().to_list()
-        if uri in uri_list:
-            uri_list.remove(uri)
-        stat_dicts = []
-        for uri in uri_list:
-            uri_df = df_in[df_in["book"] == uri]
-            uri_df["length"] = uri_df["end"] - uri_df["begin"]
-            stat_dicts.append({"uri": uri, "length": uri_df["length"].sum(), "instances": len(uri_df)})
-        
-        return pd.DataFrame(stat_dicts)
+            df_in = df_in[df_in["book"].str.split(".").str[0] != uri_author]
+        df_in = df_in[df_in["book"] != uri]
+
+        lengths = (df_in["end"] - df_in["begin"]).astype("int64").groupby(df_in["book"], observed=True)
+        stats_df = pd.DataFrame({"length": lengths.sum(), "instances": lengths.size()})
+        return stats_df.rename_axis("uri").reset_index()
+
+    def _date_mask(self, cl_df, min_date, max_date):
+        return cl_df["date"].ge(min_date) & cl_df["date"].le(max_date)
+
+    def _author_mask(self, cl_df, author_list):
+        return cl_df["book"].str.split(".").str[0].isin(author_list)
+
+    def _book_mask(self, cl_df, book_list, exclude_listed_books=False):
+        mask = cl_df["book"].isin(book_list)
+        if exclude_listed_books:
+            mask = ~mask
+        return mask
 
     # Function to apply a date filter to the df
-    def filter_by_date_range(self, min_date = 0, max_date= 1500, df_in=None, return_df=False):
+    def filter_by_date_range(self, min_date = 0, max_date= 1500, df_in=None, return_df=False, clean=True):
         """Needs more careful refactoring, as there's no reason to filter self.cluster_df if an input df has been given. The default
-        behaviour when df_in does not equal none would be to return a df"""
+        behaviour when df_in does not equal none would be to return a df
+        clean: if False the single clusters are left in - use when chaining filters and clean once at the end"""
         if df_in is not None:
-            cluster_df = df_in[df_in["date"].le(max_date)]
-            cluster_df = cluster_df[cluster_df["date"].ge(min_date)]
-            cluster_df = self.clean_single_clusters(cluster_df)
+            cluster_df = df_in[self._date_mask(df_in, min_date, max_date)]
+            if clean:
+                cluster_df = self.clean_single_clusters(cluster_df)
             return cluster_df
         else:
-            if return_df:
-                cluster_df = self.cluster_df[self.cluster_df["date"].le(max_date)]
-                cluster_df = cluster_df[cluster_df["date"].ge(min_date)]
+            cluster_df = self.cluster_df[self._date_mask(self.cluster_df, min_date, max_date)]
+            if clean:
                 cluster_df = self.clean_single_clusters(cluster_df)
+            if return_df:
                 return cluster_df
             else:
-                self.cluster_df = self.cluster_df[self.cluster_df["date"].le(max_date)]
-                self.cluster_df = self.cluster_df[self.cluster_df["date"].ge(min_date)]
-                self.cluster_df = self.clean_single_clusters(self.cluster_df)
+                self.cluster_df = cluster_df
 
-    def filter_by_author_list(self, author_list):
+    def filter_by_author_list(self, author_list, clean=True):
         print("Filtering clusters by authors: {}".format(author_list))
-        author_df = self.cluster_df.copy()
-        author_df["author"] = author_df["book"].str.split(".", expand=True)[0]        
-        self.cluster_df = author_df[author_df["author"].isin(author_list)]
-        self.cluster_df = self.clean_single_clusters(self.cluster_df)
-        self.cluster_df.drop(columns=["author"])
+        self.cluster_df = self.cluster_df[self._author_mask(self.cluster_df, author_list)]
+        if clean:
+            self.cluster_df = self.clean_single_clusters(self.cluster_df)
     
-    def filter_by_book_list(self, book_list, exclude_listed_books=False):
+    def filter_by_book_list(self, book_list, exclude_listed_books=False, clean=True):
         """If exclude_listed_books is true - it will return the only rows that do not match the book list"""
         if exclude_listed_books:
             print("Filtering clusters to exclude books: {}".format(book_list))
-            self.cluster_df = self.cluster_df[~self.cluster_df["book"].isin(book_list)]
         else:
             print("Filtering clusters by books: {}".format(book_list))
-            self.cluster_df = self.cluster_df[self.cluster_df["book"].isin(book_list)]
-        self.cluster_df = self.clean_single_clusters(self.cluster_df)
+        self.cluster_df = self.cluster_df[self._book_mask(self.cluster_df, book_list, exclude_listed_books)]
+        if clean:
+            self.cluster_df = self.clean_single_clusters(self.cluster_df)
+
+    def apply_filters(self, min_date=None, max_date=None, author_list=None, book_list=None, exclude_books=None, df_in=None):
+        """Apply several filters in one pass: the masks are combined, the df is filtered once and the single clusters are cleaned
+        once at the end. This gives the same result as running the filters one after the other (each filter only removes rows,
+        so any cluster left with one row by an earlier filter is still removed by the final clean)
+        min_date, max_date: date range to keep (either can be given on its own)
+        author_list: only keep rows from these authors
+        book_list: only keep rows from these books
+        exclude_books: drop rows from these books
+        df_in: if given, filter and return this df, otherwise self.cluster_df is filtered in place"""
+        cl_df = self.cluster_df if df_in is None else df_in
+        mask = np.ones(len(cl_df), dtype=bool)
+        if min_date is not None:
+            mask &= cl_df["date"].ge(min_date).to_numpy()
+        if max_date is not None:
+            mask &= cl_df["date"].le(max_date).to_numpy()
+        if author_list is not None:
+            mask &= self._author_mask(cl_df, author_list).to_numpy()
+        if book_list is not None:
+            mask &= self._book_mask(cl_df, book_list).to_numpy()
+        if exclude_books is not None:
+            mask &= self._book_mask(cl_df, exclude_books, exclude_listed_books=True).to_numpy()
+        
+        cl_df = self.clean_single_clusters(cl_df[mask])
+        if df_in is None:
+            self.cluster_df = cl_df
+        else:
+            return cl_df
 
     def return_cluster_df_for_uri_ms(self, primary_book, ms = None, input_type = "range", min_date = None, max_date = None):
         # None type allows this function to be used to fetch all of the clusters for an entire text (rather than specified milestones)
@@ -167,10 +554,11 @@ class clusterDf():
                 
             clusters = self.fetch_clusters_by_uri_mslist(primary_book, ms_list)
 
-        cluster_df = self.cluster_df[self.cluster_df["cluster"].isin(clusters)]
+        # Every row of the clusters is fetched, so the date filter can use the cached view of the clusters that survive it
+        positions = self.fetch_cluster_positions(clusters)
         if min_date is not None and max_date is not None:
-            cluster_df = self.filter_by_date_range(min_date=min_date, max_date=max_date, df_in=cluster_df)
-        return cluster_df
+            positions = self.filter_positions_by_date(positions, min_date, max_date)
+        return self.cluster_df.iloc[positions]
     
     def print_aggregated_stats(self, greater_than_measure = 100):
         # Perform calculations
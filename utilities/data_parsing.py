@@ -1,8 +1,169 @@
 """Classes used for storing, processing and converting data types used across pipelines
 for easy conversion to csv or LabelStudio compliant data"""
+from utilities.instrumentation import get_metrics
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Columnar layout of the gaps data - one row per gap side. 'side' is the position of the gap in the record's gaps_data
+# (side 0 is the primary book - the book the gap was found in). 'books' and the coverage of the gap (gap_chars and
+# covered_chars, from query_book with coverage="annotate") are only filled on side 0
+GAPS_SCHEMA = pa.schema([
+    ("index", pa.int64()),
+    ("side", pa.int32()),
+    ("book", pa.string()),
+    ("primary_book", pa.string()),
+    ("start_ms", pa.int64()),
+    ("start_ch", pa.int64()),
+    ("end_ms", pa.int64()),
+    ("end_ch", pa.int64()),
+    ("before_ms", pa.int64()),
+    ("before_start_ch", pa.int64()),
+    ("before_end_ch", pa.int64()),
+    ("after_ms", pa.int64()),
+    ("after_start_ch", pa.int64()),
+    ("after_end_ch", pa.int64()),
+    ("text", pa.string()),
+    ("text_before", pa.string()),
+    ("text_after", pa.string()),
+    ("books", pa.list_(pa.string())),
+    ("gap_chars", pa.int64()),
+    ("covered_chars", pa.int64())
+])
+
+# Keys of a gaps record that are held in the table - any other key is dropped by gaps_to_table
+GAPS_RECORD_KEYS = ["index", "gaps_data", "books", "coverage"]
+
+# Columns that every gap side must have - the rest are optional and may be null
+GAPS_REQUIRED_COLUMNS = ["index", "side", "book", "primary_book", "start_ms", "start_ch", "end_ms", "end_ch", "text"]
+
+def gaps_to_table(gaps_data, with_text=True):
+    """Convert a list of gaps records (see gapsClusters) into an arrow table with one row per gap side (see GAPS_SCHEMA).
+    Keys that are not part of the schema (e.g. supporting_data from query_book data_check) are not kept - a warning is
+    printed with the keys that were dropped
+    with_text: if False the text columns are left empty - for tables that are only used for the positions of the sides
+    (e.g. by parse_to_pairs), so the texts are not copied out of the records"""
+    columns = {field.name: [] for field in GAPS_SCHEMA}
+    dropped_keys = set()
+    for row in gaps_data:
+        dropped_keys.update(key for key in row.keys() if key not in GAPS_RECORD_KEYS)
+        coverage = row.get("coverage", {})
+        gaps = row["gaps_data"]
+        primary_book = gaps[0]["book"] if len(gaps) > 0 else None
+        for side, gap in enumerate(gaps):
+            before = gap.get("before", {})
+            after = gap.get("after", {})
+            columns["index"].append(row["index"])
+            columns["side"].append(side)
+            columns["book"].append(gap["book"])
+            columns["primary_book"].append(primary_book)
+            columns["start_ms"].append(gap["start"]["ms"])
+            columns["start_ch"].append(gap["start"]["ch"])
+            columns["end_ms"].append(gap["end"]["ms"])
+            columns["end_ch"].append(gap["end"]["ch"])
+            columns["before_ms"].append(before.get("ms"))
+            columns["before_start_ch"].append(before.get("start_ch"))
+            columns["before_end_ch"].append(before.get("end_ch"))
+            columns["after_ms"].append(after.get("ms"))
+            columns["after_start_ch"].append(after.get("start_ch"))
+            columns["after_end_ch"].append(after.get("end_ch"))
+            columns["text"].append(gap.get("text") if with_text else None)
+            columns["text_before"].append(gap.get("text_before") if with_text else None)
+            columns["text_after"].append(gap.get("text_after") if with_text else None)
+            columns["books"].append(row.get("books") if side == 0 else None)
+            columns["gap_chars"].append(coverage.get("gap_chars") if side == 0 else None)
+            columns["covered_chars"].append(coverage.get("covered_chars") if side == 0 else None)
+    if with_text and len(dropped_keys) > 0:
+        print(f"Warning: the gaps table does not hold the keys {sorted(dropped_keys)} - they are not kept")
+    return pa.table(columns, schema=GAPS_SCHEMA)
+
+def table_to_gaps(table):
+    """Convert a table of gap sides (see gaps_to_table) back into a list of gaps records. The sides of a record are
+    consecutive rows in the table and each record starts with its side 0"""
+    columns = {name: table.column(name).to_pylist() if name in table.column_names else [None] * table.num_rows
+               for name in GAPS_SCHEMA.names}
+    records = []
+    for values in zip(*[columns[name] for name in GAPS_SCHEMA.names]):
+        side = dict(zip(GAPS_SCHEMA.names, values))
+        gap = {"book": side["book"],
+               "start": {"ms": side["start_ms"], "ch": side["start_ch"]},
+               "end": {"ms": side["end_ms"], "ch": side["end_ch"]}}
+        if side["before_ms"] is not None:
+            gap["before"] = {"ms": side["before_ms"], "start_ch": side["before_start_ch"], "end_ch": side["before_end_ch"]}
+        if side["after_ms"] is not None:
+            gap["after"] = {"ms": side["after_ms"], "start_ch": side["after_start_ch"], "end_ch": side["after_end_ch"]}
+        for text_key in ["text", "text_before", "text_after"]:
+            if side[text_key] is not None:
+                gap[text_key] = side[text_key]
+        if side["side"] == 0:
+            records.append({"index": side["index"], "gaps_data": [], "books": side["books"]})
+            if side["gap_chars"] is not None:
+                records[-1]["coverage"] = {"gap_chars": side["gap_chars"], "covered_chars": side["covered_chars"]}
+        records[-1]["gaps_data"].append(gap)
+    return records
+
+class ndjsonGaps():
+    """A lazy view of a line-delimited (NDJSON) gaps file - one gaps record per line. Each iteration reads the file again one
+    record at a time, so memory use does not depend on the size of the file. If the last line is incomplete (a run that
+    crashed while writing) it is skipped with a warning and every complete record is still returned"""
+    def __init__(self, path, check_row=None):
+        """check_row: a function applied to each record as it is read (e.g. gapsClusters.check_row)"""
+        self.path = path
+        self.check_row = check_row
+
+    def __iter__(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    if line.endswith("\n"):
+                        raise
+                    print(f"Incomplete final record in {self.path} - skipping it")
+                    return
+                if self.check_row is not None:
+                    self.check_row(row)
+                yield row
+
+
+class gapsWriter():
+    """Write gaps records to a line-delimited (NDJSON) file as they are produced. Every write is flushed, so a run that
+    crashes keeps all of the records written before the crash
+    Use as a context manager:
+    with gapsWriter(path) as writer:
+        writer.write(record)"""
+    def __init__(self, path, append=False):
+        self.path = path
+        self.file = open(path, "a" if append else "w", encoding="utf-8")
+        self.records_written = 0
+
+    def write(self, row):
+        self.file.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.records_written += 1
+
+    def write_many(self, rows):
+        for row in rows:
+            self.file.write(json.dumps(row, ensure_ascii=False) + "\n")
+            self.records_written += 1
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 
 class gapsClusters():
     """Take list of dictionaries formated like this and render it as a series of formats:
@@ -20,71 +181,134 @@ class gapsClusters():
            {"book": "0000AuthorBook", "start": {"ms": 1, "ch": 200}, "end": {"ms": 1, "ch": 300}, "text": "..."}]
             }
         }
-        ]"""
-    def __init__(self, gaps_data):
-        """Load from either json or take a gaps_dict directly. Check that the data conforms to format - if so assign it"""
+        ]
+    The data can also be given as a path to a line-delimited file (.jsonl or .ndjson) with one record per line - this is
+    read lazily (see ndjsonGaps) and each record is checked as it is read
+    Or as an arrow table / path to a parquet file with one row per gap side (see GAPS_SCHEMA) - the gaps are then held in
+    the table and the list of dicts is only built if it is needed"""
+    def __init__(self, gaps_data, books=None, primary_books=None):
+        """Load from either json or take a gaps_dict directly. Check that the data conforms to format - if so assign it
+        books, primary_books: when loading a parquet file, only load the records that contain one of the books or whose
+        primary book (the book the gap was found in) is one of primary_books"""
         
+        self.gaps_table = None
+        self._gaps_dict = None
+        self._side_texts = None
+
         # If the input is a str check it and load it
         if type(gaps_data) == str:
             if gaps_data.split(".")[-1] == "json":
                 gaps_data = self.load_json(gaps_data)
+            elif gaps_data.split(".")[-1] in ["jsonl", "ndjson"]:
+                gaps_data = self.load_ndjson(gaps_data)
+            elif gaps_data.split(".")[-1] == "parquet":
+                gaps_data = self.load_parquet(gaps_data, books=books, primary_books=primary_books)
             else:
                 print(f"invalid file path: {gaps_data}")
                 exit()
 
-        # Check the data structure
-        self.check_data_dict(gaps_data)
+        # Check the data structure - lazy data is checked record by record as it is read
+        if isinstance(gaps_data, pa.Table):
+            self.check_table(gaps_data)
+            self.gaps_table = gaps_data
+            return
+        elif isinstance(gaps_data, ndjsonGaps):
+            self.surround_text = False
+            for row in gaps_data:
+                break
+        else:
+            self.check_data_dict(gaps_data)
 
         # Store the data dict
         self.gaps_dict = gaps_data
 
+    @property
+    def gaps_dict(self):
+        # If the gaps are held as a table - only build the list of dicts when it is first needed
+        if self._gaps_dict is None and self.gaps_table is not None:
+            self._gaps_dict = table_to_gaps(self.gaps_table)
+        return self._gaps_dict
+
+    @gaps_dict.setter
+    def gaps_dict(self, gaps_data):
+        self._gaps_dict = gaps_data
+        self.gaps_table = None
+        self._side_texts = None
+
+    def to_table(self):
+        """Return the gaps as an arrow table with one row per gap side (see GAPS_SCHEMA)"""
+        if self.gaps_table is None:
+            self.gaps_table = gaps_to_table(self._gaps_dict)
+        return self.gaps_table
+
+    def check_table(self, table):
+        """Vectorised version of check_data_dict for a table of gap sides - check that the required columns are there
+        and contain no nulls"""
+        for column in GAPS_REQUIRED_COLUMNS:
+            if column not in table.column_names:
+                print(f"Error found in {column} column - column missing")
+                exit()
+            if table.column(column).null_count > 0:
+                print(f"Error found in {column} column - {table.column(column).null_count} rows are missing values")
+                exit()
+        
+        # Text before and after is only used if every gap side has it
+        self.surround_text = table.num_rows > 0
+        for column in ["text_before", "text_after"]:
+            if column not in table.column_names or table.column(column).null_count > 0:
+                self.surround_text = False
+
     
     def check_data_dict(self, gaps_dict):
 
         """Quite naive - just exit when we find the first error - we could write a log of errors if useful"""
         for row in gaps_dict:
-            if "index" not in row.keys():
-                print("Error found in index key")
-                exit()
-            if "gaps_data" in row.keys():
-                gaps_data = row["gaps_data"]
-                for gap in gaps_data:
-                    if "book" not in gap.keys():
-                        print("Error found in 'book' key")
+            self.check_row(row)
+
+    def check_row(self, row):
+        """Check one record of the gaps data - see check_data_dict"""
+        if "index" not in row.keys():
+            print("Error found in index key")
+            exit()
+        if "gaps_data" in row.keys():
+            gaps_data = row["gaps_data"]
+            for gap in gaps_data:
+                if "book" not in gap.keys():
+                    print("Error found in 'book' key")
+                    exit()
+                if "start" in gap.keys():
+                    start = gap["start"]
+                    if "ms" not in start.keys():
+                        print("Error found in ms key for start")
                         exit()
-                    if "start" in gap.keys():
-                        start = gap["start"]
-                        if "ms" not in start.keys():
-                            print("Error found in ms key for start")
-                            exit()
-                        if "ch" not in start.keys():
-                            print("Error found in ch key for start ")
-                            exit()
-                    else:
+                    if "ch" not in start.keys():
+                        print("Error found in ch key for start ")
                         exit()
-                    if "end" in gap.keys():
-                        end = gap["end"]
-                        if "ms" not in end.keys():
-                            print("Error found in ms key for end")
-                            exit()
-                        if "ch" not in end.keys():
-                            print("Error found in ch key for end")
-                            exit()
-                    else:
+                else:
+                    exit()
+                if "end" in gap.keys():
+                    end = gap["end"]
+                    if "ms" not in end.keys():
+                        print("Error found in ms key for end")
                         exit()
-                    if "text" not in gap.keys():
-                        print("Error found in text key")
+                    if "ch" not in end.keys():
+                        print("Error found in ch key for end")
                         exit()
-                    if "text_after" in gap.keys() and "text_before" in gap.keys():
-                        self.surround_text = True
-                    else:
-                        self.surround_text = False
-            else:
-                print("Error found in 'gaps_data' key")
-                exit()
-            if "books" not in row.keys():
-                print("Error found in books key")
-                exit()
+                else:
+                    exit()
+                if "text" not in gap.keys():
+                    print("Error found in text key")
+                    exit()
+                if "text_after" in gap.keys() and "text_before" in gap.keys():
+                    self.surround_text = True
+                else:
+                    self.surround_text = False
+        else:
+            print("Error found in 'gaps_data' key")
+            exit()
+        if "books" not in row.keys():
+            print("Error found in books key")
+            exit()
 
 
 
@@ -93,42 +317,157 @@ class gapsClusters():
         with open(export_path, "w", encoding='utf-8') as f:
             f.write(json_string)        
 
+    def write_json_stream(self, rows, export_path, indent=4):
+        """Write an iterable of records to a json list one record at a time, rather than building the whole json string
+        in memory. The output is the same as write_json"""
+        with open(export_path, "w", encoding='utf-8') as f:
+            separator = ",\n" if indent is not None else ", "
+            first = True
+            for row in rows:
+                row_string = json.dumps(row, ensure_ascii=False, indent=indent)
+                if indent is not None:
+                    row_string = " " * indent + row_string.replace("\n", "\n" + " " * indent)
+                f.write(("[\n" if indent is not None else "[") if first else separator)
+                f.write(row_string)
+                first = False
+            if first:
+                f.write("[]")
+            else:
+                f.write("\n]" if indent is not None else "]")
+
     def load_json(self, json_path):
         with open(json_path, 'r', encoding='utf-8') as f:
             data = json.load(f)
         return data
+
+    def load_parquet(self, parquet_path, books=None, primary_books=None):
+        """Read a parquet file of gap sides. Filters are pushed down to the parquet reader, so row groups that cannot
+        match are not read
+        books: only load the records that contain at least one of these books (on any side) - records are matched on their
+        'index' and primary book, as indexes are only unique within the gaps of one book in some runs (e.g. single book runs)
+        primary_books: only load the records whose primary book is one of these books"""
+        filters = []
+        if primary_books is not None:
+            filters.append(("primary_book", "in", list(primary_books)))
+        if books is None:
+            return pq.read_table(parquet_path, filters=filters if len(filters) > 0 else None)
+
+        # Find the records that contain the books, then load every side of the records with any of their indexes and
+        # primary books, and drop the sides of other records that only share the index or the primary book
+        matching = pq.read_table(parquet_path, columns=["index", "primary_book"], filters=filters + [("book", "in", list(books))])
+        if matching.num_rows == 0:
+            return pq.read_schema(parquet_path).empty_table()
+        filters.append(("index", "in", pc.unique(matching.column("index")).to_pylist()))
+        filters.append(("primary_book", "in", pc.unique(matching.column("primary_book")).to_pylist()))
+        table = pq.read_table(parquet_path, filters=filters)
+        record_keys = pd.MultiIndex.from_arrays([table.column("index").to_numpy(), table.column("primary_book").to_numpy(zero_copy_only=False)])
+        matching_keys = pd.MultiIndex.from_arrays([matching.column("index").to_numpy(), matching.column("primary_book").to_numpy(zero_copy_only=False)])
+        return table.filter(pa.array(record_keys.isin(matching_keys)))
+
+    def load_ndjson(self, ndjson_path):
+        """Return a lazy view of a line-delimited gaps file"""
+        return ndjsonGaps(ndjson_path, check_row=self.check_row)
     
+    def _count_written(self, path):
+        """Add a written file to the metrics (see utilities.instrumentation)"""
+        metrics = get_metrics()
+        if metrics.enabled:
+            metrics.count("files_written")
+            metrics.count("bytes_written", os.path.getsize(path))
+
     def save_json(self, export_path):
         """Export the gaps dict as a json file"""
-        self.write_json(self.gaps_dict, export_path)
-
-    def parse_to_pairs(self):
-        """This function parses the data into dataframe of bidirectional pairs (so all data is repeated) - this allows for easier filtering"""
-        out_data = []
-        for row in self.gaps_dict:
-            gaps_data = row["gaps_data"]
-            for data in gaps_data:
-                for data_pair in gaps_data:
-                    if not data["book"] == data_pair["book"]:
-                        data_row = {"book1": data["book"], 
-                                    "book2": data_pair["book"], 
-                                    "start_ms1": data["start"]["ms"],
-                                    "start_ms2": data_pair["start"]["ms"],
-                                    "start1": data["start"]["ch"],
-                                    "start2": data_pair["start"]["ch"],
-                                    "end_ms1": data["end"]["ms"],
-                                    "end_ms2": data_pair["end"]["ms"],
-                                    "end1": data["end"]["ch"],
-                                    "end2": data_pair["end"]["ch"],
-                                    "text1": data["text"],
-                                    "text2": data_pair["text"]}
-                        if self.surround_text:
-                            data_row["text_before1"] = data["text_before"]
-                            data_row["text_before2"] = data_pair["text_before"]
-                            data_row["text_after1"] = data["text_after"]
-                            data_row["text_after2"] = data_pair["text_after"]
-                        out_data.append(data_row)
-        return pd.DataFrame(out_data)
+        with get_metrics().stage("save_gaps"):
+            self.write_json_stream(self.gaps_dict, export_path)
+            self._count_written(export_path)
+
+    def save_parquet(self, export_path, row_group_size=100000):
+        """Export the gaps as a parquet file with one row per gap side (see GAPS_SCHEMA). Rows are kept in index order,
+        so row groups cover runs of primary books and filters on primary_book skip most of the file"""
+        with get_metrics().stage("save_gaps"):
+            pq.write_table(self.to_table(), export_path, row_group_size=row_group_size)
+            self._count_written(export_path)
+
+    def save_ndjson(self, export_path):
+        """Export the gaps dict as a line-delimited json file - one record per line"""
+        with get_metrics().stage("save_gaps"):
+            with gapsWriter(export_path) as writer:
+                for row in self.gaps_dict:
+                    writer.write(row)
+            self._count_written(export_path)
+
+    def parse_to_pairs(self, with_text=True):
+        """This function parses the data into dataframe of bidirectional pairs (so all data is repeated) - this allows for easier filtering
+        The gaps are normalised to one row per side (see to_table) and every side is paired with the other sides of its record
+        in a single merge - pairs of sides from the same book are dropped
+        with_text: if False, the text columns are replaced by side_id1 and side_id2 - the rows of the sides in side_texts().
+        Each text is then only held once, however many pairs it is in - use join_pair_texts to add the text back"""
+        with get_metrics().stage("parse_to_pairs"):
+            pairs = self._parse_to_pairs(with_text)
+            get_metrics().count("pairs", len(pairs))
+        return pairs
+
+    def _parse_to_pairs(self, with_text):
+        # Only the positions of the sides are needed here - if the gaps are held as records, build a table without the texts
+        # rather than copying every text into the table
+        table = self.gaps_table if self.gaps_table is not None else gaps_to_table(self._gaps_dict, with_text=False)
+        if table.num_rows == 0:
+            return pd.DataFrame()
+        
+        sides = table.select(["side", "book", "start_ms", "start_ch", "end_ms", "end_ch"]).to_pandas()
+        sides["side_id"] = np.arange(len(sides))
+
+        # Number the records - a record starts at each side 0 (indexes are not always unique, e.g. single book runs)
+        sides["record"] = (sides["side"] == 0).cumsum()
+
+        # Pair each side with every side of the same record, in the order of the nested loop over the sides
+        pairs = sides.merge(sides, on="record", suffixes=("1", "2"))
+        pairs = pairs[pairs["book1"] != pairs["book2"]]
+        pairs = pairs.sort_values(by=["record", "side1", "side2"], kind="stable")
+        if len(pairs) == 0:
+            return pd.DataFrame()
+
+        pairs = pairs.rename(columns={"start_ch1": "start1", "start_ch2": "start2", "end_ch1": "end1", "end_ch2": "end2"})
+        pairs = pairs[["book1", "book2", "start_ms1", "start_ms2", "start1", "start2", "end_ms1", "end_ms2", "end1", "end2",
+                       "side_id1", "side_id2"]].reset_index(drop=True)
+        
+        if with_text:
+            pairs = self.join_pair_texts(pairs)
+        return pairs
+
+    def side_texts(self):
+        """Return a df of the texts of the gap sides - one row per side, in the order of to_table (the side_ids used by
+        parse_to_pairs(with_text=False)). The columns are categoricals, so each distinct text is only held once however many
+        sides share it - from the records themselves if the gaps are held as records, or dictionary encoded from the table"""
+        if self._side_texts is None:
+            text_columns = ["text"]
+            if self.surround_text:
+                text_columns = text_columns + ["text_before", "text_after"]
+            side_texts = {}
+            for text_column in text_columns:
+                if self.gaps_table is not None:
+                    side_texts[text_column] = self.gaps_table.column(text_column).dictionary_encode().to_pandas()
+                else:
+                    # Number the distinct texts - the categories are the text objects of the records, so nothing is copied
+                    text_codes = {}
+                    codes = [text_codes.setdefault(gap.get(text_column), len(text_codes)) if gap.get(text_column) is not None else -1
+                             for row in self._gaps_dict for gap in row["gaps_data"]]
+                    side_texts[text_column] = pd.Categorical.from_codes(codes, categories=pd.Index(list(text_codes), dtype=object))
+            self._side_texts = pd.DataFrame(side_texts)
+        return self._side_texts
+
+    def join_pair_texts(self, pairs):
+        """Replace the side_id1 and side_id2 columns of a pairs df (from parse_to_pairs(with_text=False)) with the text
+        columns of the sides - gives the same columns as parse_to_pairs()"""
+        texts = self.side_texts()
+        side_ids = {"1": pairs["side_id1"].to_numpy(), "2": pairs["side_id2"].to_numpy()}
+        pairs = pairs.drop(columns=["side_id1", "side_id2"])
+        for text_column in texts.columns:
+            categories = texts[text_column].cat.categories
+            codes = texts[text_column].cat.codes.to_numpy()
+            for side in ["1", "2"]:
+                pairs[f"{text_column}{side}"] = pd.Categorical.from_codes(codes[side_ids[side]], categories=categories).astype("str")
+        return pairs
 
     def _build_pairwise_dfs(self, df, primary_book):
         """Look through a df of bidirectional pairs and create separate dfs for each pair
@@ -139,14 +478,8 @@ class gapsClusters():
         # Get just all the rows with the primary book in book1 position
         df = df[df["book1"] == primary_book]
 
-        # Fetch the book2s
-        book_pairs = df["book2"].drop_duplicates().tolist()
-
-        # Loop through book2s, split out the dfs and add to out dict
-        out_dfs = {}
-        for book_pair in book_pairs:
-            filtered_df = df[df["book2"] == book_pair]
-            out_dfs[book_pair] = filtered_df
+        # Split out the dfs for each book2 in one pass (in order of first appearance of the book2)
+        out_dfs = {book_pair: filtered_df for book_pair, filtered_df in df.groupby("book2", sort=False)}
 
         return out_dfs
 
@@ -160,15 +493,16 @@ class gapsClusters():
         # Get all the book1s
         if books is None:
             books = df["book1"].drop_duplicates().tolist()
-        elif type(books) == str:
-            books = [books]
+        else:
+            if type(books) == str:
+                books = [books]
+            df = df[df["book1"].isin(books)]
         
 
-        # Loop through book1s treating them as the primary_book - store output as dict
-        all_pairs = {}
-        for book in books:
-            out_dfs = self._build_pairwise_dfs(df, book)
-            all_pairs[book] = out_dfs
+        # Split the df by book1 and book2 in one groupby pass - treating each book1 as the primary_book
+        all_pairs = {book: {} for book in books}
+        for (book, book_pair), filtered_df in df.groupby(["book1", "book2"], sort=False):
+            all_pairs[book][book_pair] = filtered_df
         
         return all_pairs
 
@@ -176,12 +510,24 @@ class gapsClusters():
         if not os.path.exists(dir):
             os.mkdir(dir)
 
-    def _write_pairwise_dirs(self, parent_dir, dfs, format):
+    def _write_pairwise_file(self, df, full_path, format, indent=4):
+        """Write one pairwise df as a csv or label studio json - if the df holds side ids, the text is joined in here"""
+        if "side_id1" in df.columns:
+            df = self.join_pair_texts(df)
+        if format == 'csv':
+            df.to_csv(full_path, encoding='utf-8-sig', index=False)
+        if format == 'label_studio':
+            self._to_label_studio_json(df, full_path, indent=indent)
+        self._count_written(full_path)
+
+    def _write_pairwise_dirs(self, parent_dir, dfs, format, workers=None, indent=4):
         """Take a dict of dfs and use it to build pairwise directory structure and write out csvs
         parent_dir: the directory where all data outputs will be stored
         dfs: df structure produced by either _build_df_all_pairs or _build_pairwise_dfs
         format: 'csv' or 'label_studio' - allows same process to be applied for either label_studio jsons
-        or csvs"""
+        or csvs
+        workers: number of threads used to write the files - defaults to the ThreadPoolExecutor default
+        indent: indent of label studio jsons - None writes compact json"""
         
         if format == 'label_studio':
             ext = 'json'
@@ -189,31 +535,32 @@ class gapsClusters():
         else:
             ext = format
 
-        primary_books = dfs.keys()
+        # Create the directory for each primary book once, before writing any files
+        primary_books = [book for book in dfs.keys() if len(dfs[book]) > 0]
         for book in primary_books:
-            book_pairs = dfs[book].keys()
-            for book_pair in book_pairs:
-                file_name = f"{book}_{book_pair}.{ext}"
-                base_path = os.path.join(parent_dir, book)
-                self._check_create_dir(base_path)
-                full_path = os.path.join(base_path, file_name)
+            os.makedirs(os.path.join(parent_dir, book), exist_ok=True)
 
-                df = dfs[book][book_pair]
-                
-                if format == 'csv':
-                    df.to_csv(full_path, encoding='utf-8-sig', index=False)
-                if format == 'label_studio':
-                    self._to_label_studio_json(df, full_path)
+        # Write the files across a bounded pool of threads - result() raises any error from the writes
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for book in primary_books:
+                base_path = os.path.join(parent_dir, book)
+                for book_pair, df in dfs[book].items():
+                    full_path = os.path.join(base_path, f"{book}_{book_pair}.{ext}")
+                    futures.append(executor.submit(self._write_pairwise_file, df, full_path, format, indent))
+            for future in futures:
+                future.result()
 
-    def export_csv(self, directory, sep_pairwise=False, primary_books=None):
+    def export_csv(self, directory, sep_pairwise=False, primary_books=None, workers=None):
         """Convert the dataset into a pairwise representation and export it as pairwise structure.
         sep_pairwise: True/False - if true, each pair of books will be exported as a separate csv if False
                         one csv will be exported for all pairs (bi-directional)
         primary_book: only export relationships with one primary (produces one folder with csvs for each pair with the primary
-                    book)"""
+                    book)
+        workers: number of threads used to write the pairwise files"""
         
         # Run the pairwise exporter with csv format
-        self._pairwise_exporter(directory, 'csv', sep_pairwise, primary_books)
+        self._pairwise_exporter(directory, 'csv', sep_pairwise, primary_books, workers)
     
     def _convert_to_prediction(self, text_key, before_key, after_key, ref, data_dict, label="Paraphrase"):
         """Take a row of pairwise data and use it to produce a prediction type format for label studio
@@ -255,17 +602,16 @@ class gapsClusters():
         return full_text, prediction
 
 
-    def _to_label_studio(self, df):
-        """Take a df, loop through each row and format it as a label_studio compliant dict"""
-
-        # Initialise empty list to append data to
-        out = []
+    def _iter_label_studio(self, df):
+        """Take a df and yield each row formated as a label_studio compliant dict - one task at a time, so a whole file
+        of tasks is never held in memory. The prediction offsets are the same as _convert_to_prediction"""
 
-        # Convert to list of dicts for easier processing
-        rows = df.to_dict("records")
+        # Read the columns as lists of python values rather than converting the df to a list of dicts
+        columns = df.columns.tolist()
+        values = [df[column].tolist() for column in columns]
 
-        # Loop through rows
-        for row in rows:
+        for row_values in zip(*values):
+            row = dict(zip(columns, row_values))
 
             # If we have a before and after then some processing is required to create predictions
             if self.surround_text:
@@ -274,7 +620,7 @@ class gapsClusters():
                 row["text1"] = full_text_a
                 row["text2"] = full_text_b
 
-                processed_data = {"data": row,
+                yield {"data": row,
                     "predictions": [
                         {"model_version": "passim_gaps",
                          "result": [
@@ -286,24 +632,24 @@ class gapsClusters():
                     ]
                 }
 
-            
             else:
-                processed_data = {"data": row}
-            
-            out.append(processed_data)
-        
-        return out
+                yield {"data": row}
 
 
-    def _to_label_studio_json(self, df, path):
-        """Take df and write it to a json in label_studio format
+    def _to_label_studio(self, df):
+        """Take a df, loop through each row and format it as a label_studio compliant dict"""
+        return list(self._iter_label_studio(df))
+
+
+    def _to_label_studio_json(self, df, path, indent=4):
+        """Take df and write it to a json in label_studio format - tasks are written to the file as they are produced
         path: path to export json to
-        df: dataframe to export"""
-        label_studio_data = self._to_label_studio(df)
-        self.write_json(label_studio_data, path)
+        df: dataframe to export
+        indent: indent of the json - None writes compact json"""
+        self.write_json_stream(self._iter_label_studio(df), path, indent=indent)
 
 
-    def export_label_studio_json(self, directory, sep_pairwise=False, primary_books=None):
+    def export_label_studio_json(self, directory, sep_pairwise=False, primary_books=None, workers=None, compact=False):
         """Convert the dataset into a pairwise representaton and export it as a json that will import into label
         studio. If self.surround_text is True, then the text of the gap will be given as a 'prediction' and the
         full text: text_before + text + text_after will be given as the main text, with offsets for the prediction. Otherwise
@@ -312,12 +658,14 @@ class gapsClusters():
                     book1/book1_book2.json if sep_pairwise is true
         sep_pairwise: if set to true separate the data into separate jsons for each book pair, otherwise 
                     export as one json all_pairs.json 
-        primary_books: if given, only these books as book1 plus their book2s will be outputted"""
+        primary_books: if given, only these books as book1 plus their book2s will be outputted
+        workers: number of threads used to write the pairwise files
+        compact: write compact (non-indented) json - smaller files that are faster to write and load"""
 
         # Run the exporter with label studio format
-        self._pairwise_exporter(directory, 'label_studio', sep_pairwise, primary_books)
+        self._pairwise_exporter(directory, 'label_studio', sep_pairwise, primary_books, workers, indent=None if compact else 4)
     
-    def _pairwise_exporter(self, directory, format, sep_pairwise=False, primary_books=None):
+    def _pairwise_exporter(self, directory, format, sep_pairwise=False, primary_books=None, workers=None, indent=4):
         """Reusable pairwise exporter for handling different file types
         format: 'csv' or 'label_studio' 
         Allows for more flexible reuse, but custom methods"""
@@ -325,16 +673,23 @@ class gapsClusters():
                 # Check supplied dir exists - if not, create it
         self._check_create_dir(directory)
         
-        all_pairs_df = self.parse_to_pairs()
+        with get_metrics().stage(f"export_{format}"):
+            self._export_pairs(directory, format, sep_pairwise, primary_books, workers, indent)
+
+    def _export_pairs(self, directory, format, sep_pairwise, primary_books, workers, indent):
+        # Keep the pairs as side ids - the text of each side is held once and only joined in as each file is written
+        all_pairs_df = self.parse_to_pairs(with_text=False)
         
         
         if sep_pairwise:
             # Filter dfs and write out the files by looping through resulting dictionaries
             dfs = self._build_df_all_pairs(all_pairs_df, primary_books)
             
-            self._write_pairwise_dirs(directory, dfs, format)
+            self._write_pairwise_dirs(directory, dfs, format, workers, indent)
             
         else:
+            if "side_id1" in all_pairs_df.columns:
+                all_pairs_df = self.join_pair_texts(all_pairs_df)
             if format == 'csv':
                 file_path = os.path.join(directory, "all_pairs.csv")
                 all_pairs_df.to_csv(file_path, encoding='utf-8-sig', index=False)
@@ -342,4 +697,5 @@ class gapsClusters():
             if format == 'label_studio':
                 
                 file_path = os.path.join(directory, "all_pairs_label_studio.json")
-                self.to_label_studio_json(all_pairs_df, file_path)
+                self._to_label_studio_json(all_pairs_df, file_path, indent=indent)
+            self._count_written(file_path)
@@ -0,0 +1,225 @@
+"""Stage-level instrumentation for the pipelines. Code marks its stages and counts what it processes through the metrics
+object returned by get_metrics():
+with get_metrics().stage("gap_search"):
+    ...
+    get_metrics().count("gaps_emitted", len(out_data))
+By default this is a nullMetrics that does nothing, so instrumented code costs nothing unless a pipelineMetrics is set with
+set_metrics (run_pipeline does this when given a metrics_out path). Each stage records wall time, cpu time (of this process
+and of any worker processes that finished during the stage) and memory, and can be profiled with cProfile. The memory of
+a stage is sampled while it runs: rss_start_mb and peak_rss_mb are the rss of this process at the start of the stage and
+its peak during the stage (Linux only). process_peak_rss_mb and workers_process_peak_rss_mb are the peaks of this process
+and of its largest finished worker since they started - they are the same for every stage after the peak
+Worker processes are started with init_worker_metrics, which gives them their own metrics object - a worker task takes
+its counters with take_counters and returns them with its results, and they are added to the main process's counters"""
+from contextlib import contextmanager
+from datetime import datetime
+import threading
+import cProfile
+import time
+import json
+import sys
+import os
+try:
+    import resource
+except ImportError:
+    # Not available on Windows - rss and worker cpu time are not recorded
+    resource = None
+
+
+def max_rss_mb(who="self"):
+    """Return the peak resident memory so far in MB of this process (who="self") or of its largest finished child process
+    (who="children"). None where it is not available"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    if sys.platform == "darwin":
+        return usage.ru_maxrss / 2**20
+    return usage.ru_maxrss / 2**10
+
+def current_rss_mb():
+    """Return the current resident memory of this process in MB, None where it is not available (read from /proc, so Linux
+    only)"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class rssSampler():
+    """Sample the rss of this process in a background thread and keep the peak - ru_maxrss only gives the peak of the
+    whole process so far, so this is used for the peak of a stage. Peaks shorter than the interval can be missed by the
+    samples, but if the process peak rises during sampling that new peak is used
+    interval: seconds between samples"""
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.process_peak_start_mb = max_rss_mb()
+        self.start_mb = current_rss_mb()
+        self.peak_mb = self.start_mb
+        self._stop = threading.Event()
+        self._thread = None
+        if self.start_mb is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        rss = current_rss_mb()
+        if rss is not None and rss > self.peak_mb:
+            self.peak_mb = rss
+
+    def stop(self):
+        """Stop sampling and return the peak rss in MB (None where rss is not available)"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+            process_peak_mb = max_rss_mb()
+            if process_peak_mb is not None and process_peak_mb > self.process_peak_start_mb:
+                self.peak_mb = max(self.peak_mb, process_peak_mb)
+        return self.peak_mb
+
+def children_cpu_s():
+    """Return the cpu time used by the finished child processes of this process"""
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class nullMetrics():
+    """Metrics object that records nothing - used when no metrics have been set"""
+    enabled = False
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def count(self, name, value=1):
+        pass
+
+    def take_counters(self):
+        return {}
+
+
+class pipelineMetrics():
+    """Record the stages and counters of a pipeline run
+    profile_dir: if given, stages are profiled with cProfile and the stats are written to {profile_dir}/{stage}.prof
+    profile_stages: the names of the stages to profile - if None every stage that is not inside another profiled stage"""
+    enabled = True
+
+    def __init__(self, profile_dir=None, profile_stages=None):
+        self.stages = []
+        self.counters = {}
+        self.profile_dir = profile_dir
+        self.profile_stages = profile_stages
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self._start = time.perf_counter()
+        self._stack = []
+        self._profiling = False
+        self._profiler = None
+        self._lock = threading.Lock()
+
+        if profile_dir and not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager that records a stage - stages can be nested, the recorded name is the path of the stage
+        e.g. run_pipeline/gap_search"""
+        self._stack.append(name)
+        path = "/".join(self._stack)
+
+        # Profile the stage if asked to and no outer stage is already being profiled
+        profiler = None
+        if self.profile_dir and not self._profiling and (self.profile_stages is None or name in self.profile_stages):
+            profiler = cProfile.Profile()
+            self._profiling = True
+            self._profiler = profiler
+
+        counters_before = dict(self.counters)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        children_start = children_cpu_s()
+        rss_sampler = rssSampler()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.profile_dir, f"{path.replace('/', '.')}.prof"))
+                self._profiling = False
+                self._profiler = None
+
+            self.stages.append({
+                "stage": path,
+                "start_s": wall_start - self._start,
+                "wall_s": time.perf_counter() - wall_start,
+                "cpu_s": time.process_time() - cpu_start,
+                "workers_cpu_s": children_cpu_s() - children_start,
+                "rss_start_mb": rss_sampler.start_mb,
+                "peak_rss_mb": rss_sampler.stop(),
+                "process_peak_rss_mb": max_rss_mb(),
+                "workers_process_peak_rss_mb": max_rss_mb("children"),
+                "counters": {key: value - counters_before.get(key, 0) for key, value in self.counters.items()
+                             if value != counters_before.get(key, 0)}
+            })
+            self._stack.pop()
+
+    def count(self, name, value=1):
+        """Add to a counter - safe to call from threads"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def take_counters(self):
+        """Return the counters and reset them - used by worker processes to hand back what each task counted"""
+        with self._lock:
+            counters = self.counters
+            self.counters = {}
+        return counters
+
+    def to_dict(self):
+        return {"started": self.started, "total_s": time.perf_counter() - self._start, "counters": self.counters,
+                "stages": self.stages}
+
+    def save(self, out_path):
+        """Write the metrics as json"""
+        with open(out_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    def report(self):
+        """Print a summary of the stages"""
+        for stage in sorted(self.stages, key=lambda stage: stage["start_s"]):
+            depth = stage["stage"].count("/")
+            print(f"{'  ' * depth}{stage['stage'].split('/')[-1]}: {stage['wall_s']:.2f}s wall, {stage['cpu_s']:.2f}s cpu"
+                  + (f", {stage['workers_cpu_s']:.2f}s worker cpu" if stage["workers_cpu_s"] else ""))
+        for name, value in self.counters.items():
+            print(f"{name}: {value}")
+
+
+_metrics = nullMetrics()
+
+def get_metrics():
+    """Return the current metrics object"""
+    return _metrics
+
+def set_metrics(metrics):
+    """Set the current metrics object (None turns instrumentation off). Returns the previous metrics object"""
+    global _metrics
+    previous = _metrics
+    _metrics = metrics if metrics is not None else nullMetrics()
+    return previous
+
+def init_worker_metrics(enabled):
+    """Initializer for worker processes. A forked worker inherits a copy of the main process's metrics, including the
+    profiler of any stage that was being profiled when it was started - that profiler is stopped, and the worker gets
+    its own metrics object to count into (a pipelineMetrics if enabled, otherwise a nullMetrics)"""
+    profiler = getattr(_metrics, "_profiler", None)
+    if profiler is not None:
+        profiler.disable()
+    set_metrics(pipelineMetrics() if enabled else None)
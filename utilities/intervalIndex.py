@@ -0,0 +1,63 @@
+"""Interval indexes of the alignments of a book, used to check whether a gap between two alignments is covered by another
+alignment. Positions are character offsets from the start of the book (see msLengths.bookMsLengths), so a gap that runs
+across milestones can be checked in one lookup. Each index is a sorted array of merged (non-overlapping) intervals with a
+prefix sum of their lengths - any number of spans can be checked with a binary search, without scanning the alignments"""
+import numpy as np
+
+
+class bookIntervalIndex():
+    """A set of intervals [start, end) merged into sorted, non-overlapping intervals with a prefix sum of their lengths"""
+    def __init__(self, starts, ends):
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        keep = ends > starts
+        starts, ends = starts[keep], ends[keep]
+        order = np.argsort(starts, kind="stable")
+        starts, ends = starts[order], ends[order]
+
+        # An interval starts a new merged interval if it begins after every interval before it has ended
+        if len(starts) > 0:
+            running_end = np.maximum.accumulate(ends)
+            new_group = np.concatenate([[True], starts[1:] > running_end[:-1]])
+            self.starts = starts[new_group]
+            self.ends = np.maximum.reduceat(ends, np.flatnonzero(new_group))
+        else:
+            self.starts = starts
+            self.ends = ends
+        self.prefix = np.concatenate([[0], np.cumsum(self.ends - self.starts)])
+
+    def _covered_before(self, positions):
+        """Return the number of covered characters before each position"""
+        positions = np.asarray(positions, dtype=np.int64)
+        idx = np.searchsorted(self.starts, positions, side="right") - 1
+        safe_idx = np.maximum(idx, 0)
+        inside = np.clip(positions - self.starts[safe_idx], 0, self.ends[safe_idx] - self.starts[safe_idx])
+        return np.where(idx >= 0, self.prefix[safe_idx] + inside, 0)
+
+    def covered_length(self, starts, ends):
+        """Return the number of characters of each span [start, end) that are covered by the intervals"""
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.maximum(np.asarray(ends, dtype=np.int64), starts)
+        if len(self.starts) == 0:
+            return np.zeros(len(starts), dtype=np.int64)
+        return self._covered_before(ends) - self._covered_before(starts)
+
+    def is_covered(self, starts, ends):
+        """Return a boolean array - true where any part of the span [start, end) is covered"""
+        return self.covered_length(starts, ends) > 0
+
+
+def build_book_interval_index(book_clusters, book_uri, positions):
+    """Build the bookIntervalIndex of the alignments of a book with other books
+    book_clusters: the cluster rows the book is queried with (see find_shared_gaps.fetch_book_clusters) - already filtered to
+    the books dated up to the book's death date, so only alignments with those books are indexed. Alignments that are only
+    with the book itself are never counted
+    positions: the bookMsLengths used to convert (ms, ch) to book character offsets"""
+    is_book = (book_clusters["book"] == book_uri).to_numpy()
+    clusters = book_clusters["cluster"].to_numpy()
+    shared = np.isin(clusters, clusters[~is_book])
+    book_rows = book_clusters[is_book & shared]
+    seqs = book_rows["seq"].to_numpy()
+    starts = positions.to_book_offsets(seqs, book_rows["begin"].to_numpy())
+    ends = positions.to_book_offsets(seqs, book_rows["end"].to_numpy())
+    return bookIntervalIndex(starts, ends)
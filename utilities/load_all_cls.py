@@ -5,81 +5,82 @@ Created on Fri May 27 14:38:58 2022
 @author: mathe
 """
 import pandas as pd
-import pyarrow.parquet as pq
+import pyarrow as pa
+import pyarrow.dataset as ds
 import os
-from tqdm import tqdm
+
+def list_cluster_files(path):
+    """Walk the cluster directory and return the parquet and json files it contains (skipping .crc files). Any other files
+    are reported and skipped
+    Returns: dict {"parquet": [paths], "json": [paths]}"""
+    cluster_files = {"parquet": [], "json": []}
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            split_name = name.split(".")
+            if split_name[-1] == "crc":
+                continue
+            if split_name[-1] in cluster_files.keys():
+                cluster_files[split_name[-1]].append(os.path.join(root, name))
+            else:
+                print("Unrecognised file format. File name: {} ... skipping to next file".format(name))
+    return cluster_files
 
 def load_all_cls(path, meta_path, min_date=1, max_date = 900, cluster_cap = 500, columns = ["uid", "gid", "cluster", "size", "seq", "series", "text", "begin", "end"], drop_strings = False, drop_dates = True):
-    
+
     meta_df = pd.read_csv(meta_path, sep="\t")[["id", "book", "date"]]
-    
+
+    # Apply the date filter to the metadata - the inner merge then drops the cluster rows outside of the date range
+    meta_df = meta_df[meta_df["date"].ge(min_date) & meta_df["date"].le(max_date)]
+
     if path.split(".")[-1] == "csv":
         print("Loading Minified Clusters")
         all_cls = pd.read_csv(path)
-        all_cls = pd.merge(all_cls, meta_df, on="id")
         if cluster_cap is not None:
             all_cls = all_cls[all_cls["size"] < cluster_cap]
-        all_cls = all_cls[all_cls["date"].ge(min_date)]
-        all_cls = all_cls[all_cls["date"].le(max_date)]
+        all_cls = pd.merge(all_cls, meta_df, on="id")
     else:
-        all_cls = pd.DataFrame()
+        # Copy the columns so that the default list is not changed between calls
+        columns = list(columns)
         if "size" not in columns:
             columns.append("size")
         if "series" not in columns:
             columns.append("series")
+        if drop_strings:
+            if "text" in columns:
+                columns.remove("text")
+        else:
+            if "text" not in columns:
+                columns.append("text")
         print("Loading all clusters below: " + str(cluster_cap))
         print(path)
-        
-        for root, dirs, files in os.walk(path, topdown=False):
-            for name in tqdm(files):
-                file_type = None
-                split_name = name.split(".")
-                if split_name[-1] == "crc":
-                    continue
-                if split_name[-1] == "parquet":
-                    file_type = "parquet"
-                if split_name[-1] == "json":
-                    file_type = "json"
-                if file_type == None:
-                    print("Unrecognised file format. File name: {} ... skipping to next file".format(name))
-                    continue  
-                if file_type == "parquet" or file_type == "json":
-                    file_path = os.path.join(root, name)
-                    if drop_strings:
-                        if "text" in columns:
-                            columns.remove("text")
-                    else:
-                        if "text" not in columns:
-                            columns.append("text")
-                    
-                            
-                    if file_type == "json":
-                        data = pd.read_json(file_path, lines=True)[columns]
-                    else:
-                        data = pq.read_table(file_path).to_pandas()[columns]
-
-                    if cluster_cap is not None:
-                        data = data[data["size"] < cluster_cap]
-
-                    data["id"] = data["series"].str.split("-").str[0]
-                    data = pd.merge(data, meta_df, how = "inner", on ="id") 
-                    # Applying the date filter to output                
-                    data = data[data["date"].le(max_date)]
-                    data = data[data["date"].ge(min_date)]
-                    
-                    if drop_dates:
-                        data= data.drop(columns = ["date"])
-
-                    all_cls = pd.concat([all_cls, data])
-        
-    
-
-    
+
+        # Scan the files as a dataset - only reading the columns we need, with the size filter applied during the scan
+        # and the files read in parallel threads
+        scan_filter = None
+        if cluster_cap is not None:
+            scan_filter = ds.field("size") < cluster_cap
+        tables = []
+        for file_type, file_paths in list_cluster_files(path).items():
+            if len(file_paths) > 0:
+                dataset = ds.dataset(file_paths, format=file_type)
+                tables.append(dataset.to_table(columns=columns, filter=scan_filter, use_threads=True))
+
+        if len(tables) == 0:
+            all_cls = pd.DataFrame(columns=columns)
+        else:
+            all_cls = pa.concat_tables(tables, promote_options="default").to_pandas()
+
+        # Merge with the metadata once, after all of the files are loaded
+        all_cls["id"] = all_cls["series"].str.split("-").str[0]
+        all_cls = pd.merge(all_cls, meta_df, how = "inner", on ="id")
+
+    if drop_dates and path.split(".")[-1] != "csv":
+        all_cls = all_cls.drop(columns = ["date"])
 
 
     print("New cluster data loaded...")
-    
-    
-    
+
+
+
     return all_cls
 
@@ -0,0 +1,187 @@
+"""Tables of the exact lengths of the cleaned milestones of OpenITI texts. passim offsets (begin/end) are character offsets
+into the cleaned milestone, so these lengths allow gaps that cross milestone boundaries to be measured exactly.
+Tables are built once per book (see build_ms_length_tables) and cached as a small .npy file per book so the gap search
+never has to open the texts"""
+from utilities.openitiTexts import openitiTextMs
+from utilities.cleanedStore import cleanedCorpusStore
+from utilities.instrumentation import get_metrics, init_worker_metrics
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import os
+from tqdm import tqdm
+
+
+class bookMsLengths():
+    """The milestone lengths of one book. Stores the milestone numbers, the cleaned length of each milestone and a prefix
+    sum of the lengths so that any (ms, ch) position can be converted to a character position from the start of the book"""
+    def __init__(self, ms_numbers, lengths):
+        self.ms_numbers = np.asarray(ms_numbers, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.prefix = np.concatenate([[0], np.cumsum(self.lengths)])
+
+    def has_ms(self, seqs):
+        """Return a boolean array - true where the milestone number is in the table"""
+        seqs = np.asarray(seqs)
+        pos = np.minimum(np.searchsorted(self.ms_numbers, seqs), len(self.ms_numbers) - 1)
+        return self.ms_numbers[pos] == seqs
+
+    def to_book_offsets(self, seqs, chs):
+        """Convert arrays of milestone numbers and offsets into the milestone into character offsets from the start of the
+        book. Milestones must be in the table (check with has_ms)"""
+        pos = np.searchsorted(self.ms_numbers, np.asarray(seqs))
+        return self.prefix[pos] + np.asarray(chs)
+
+    def ms_length(self, seq):
+        """Return the cleaned length of a single milestone"""
+        return int(self.lengths[np.searchsorted(self.ms_numbers, seq)])
+
+
+def notional_ms_lengths(seqs, chs, av_word_len=4):
+    """Build a bookMsLengths from the offsets seen in a book's cluster rows, for milestones without an exact length.
+    Each milestone from the first to the last seen is given the notional length av_word_len * 300, or the furthest offset
+    seen in it if that is longer, so positions keep their order. Lengths across milestones are estimates"""
+    seqs = np.asarray(seqs, dtype=np.int64)
+    chs = np.asarray(chs, dtype=np.int64)
+    if len(seqs) == 0:
+        return bookMsLengths([], [])
+    ms_numbers = np.arange(seqs.min(), seqs.max() + 1)
+    lengths = np.full(len(ms_numbers), av_word_len * 300, dtype=np.int64)
+    np.maximum.at(lengths, seqs - ms_numbers[0], chs + 1)
+    return bookMsLengths(ms_numbers, lengths)
+
+def merge_ms_lengths(exact, notional):
+    """Combine an exact bookMsLengths with notional lengths (see notional_ms_lengths) for the milestones it does not hold.
+    Returns exact unchanged if it holds every milestone"""
+    if exact is None or len(exact.ms_numbers) == 0:
+        return notional
+    if len(notional.ms_numbers) == 0 or exact.has_ms(notional.ms_numbers).all():
+        return exact
+    ms_numbers = np.union1d(exact.ms_numbers, notional.ms_numbers)
+    lengths = np.empty(len(ms_numbers), dtype=np.int64)
+    lengths[np.searchsorted(ms_numbers, notional.ms_numbers)] = notional.lengths
+    lengths[np.searchsorted(ms_numbers, exact.ms_numbers)] = exact.lengths
+    return bookMsLengths(ms_numbers, lengths)
+
+def stacked_book_offsets(tables, codes, seqs, chs):
+    """Convert (ms, ch) positions of rows from several books into character offsets from the start of each row's book in
+    one searchsorted pass - the milestone numbers of all of the tables are stacked into one sorted array of (book, ms) keys
+    tables: a list of bookMsLengths, one per book
+    codes: the position in tables of the book of each row
+    seqs, chs: the milestone number and offset into the milestone of each row - every milestone must be in its book's table"""
+    codes = np.asarray(codes, dtype=np.int64)
+    seqs = np.asarray(seqs, dtype=np.int64)
+    if len(tables) == 0 or len(seqs) == 0:
+        return np.zeros(len(seqs), dtype=np.int64)
+    ms_numbers = np.concatenate([table.ms_numbers for table in tables])
+    prefixes = np.concatenate([table.prefix[:-1] for table in tables])
+    table_sizes = [len(table.ms_numbers) for table in tables]
+
+    # Keys sort by book then milestone, so each book's milestones are a contiguous run of the stacked array
+    span = max(int(ms_numbers.max(initial=0)), int(seqs.max())) + 1
+    keys = np.repeat(np.arange(len(tables), dtype=np.int64), table_sizes) * span + ms_numbers
+    pos = np.searchsorted(keys, codes * span + seqs)
+    return prefixes[pos] + np.asarray(chs)
+
+
+class msLengthTable():
+    """A directory of cached milestone length tables - one file per book: {book}.npy containing an int32 array of shape (n, 2)
+    with the milestone number and its cleaned length. Tables are loaded on first use and kept in memory"""
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.books = {}
+
+    def table_path(self, book):
+        return os.path.join(self.cache_dir, f"{book}.npy")
+
+    def __contains__(self, book):
+        return book in self.books or os.path.exists(self.table_path(book))
+
+    def get(self, book):
+        """Return the bookMsLengths for a book, or None if no table has been built for it"""
+        if book not in self.books:
+            if not os.path.exists(self.table_path(book)):
+                return None
+            table = np.load(self.table_path(book))
+            self.books[book] = bookMsLengths(table[:, 0], table[:, 1])
+        return self.books[book]
+
+    def __getstate__(self):
+        # Do not send loaded tables to worker processes - each worker loads the books it needs
+        return {"cache_dir": self.cache_dir, "books": {}}
+
+
+def write_ms_length_table(book, openiti_path, cache_dir):
+    """Read an OpenITI text once, measure every cleaned milestone and write the table to the cache"""
+    ms_obj = openitiTextMs(openiti_path)
+    ms_numbers = ms_obj.list_milestones()
+    lengths = [len(ms_obj.fetch_milestone(ms_number, clean=True)) for ms_number in ms_numbers]
+    return save_ms_length_table(book, ms_numbers, lengths, cache_dir)
+
+def write_stored_ms_length_table(book, store, cache_dir):
+    """Write the table of a book held in a store of cleaned texts (see utilities.cleanedStore) - the store already holds
+    the cleaned length of each milestone, so the text is not read"""
+    ms_obj = store.open_book(book)
+    ms_numbers, lengths = ms_obj.ms_lengths()
+    ms_obj.close()
+    return save_ms_length_table(book, ms_numbers, lengths, cache_dir)
+
+def save_ms_length_table(book, ms_numbers, lengths, cache_dir):
+    """Write the milestone numbers and cleaned lengths of a book to the cache"""
+    table = np.array([ms_numbers, lengths], dtype=np.int32).T
+
+    # Write to a temporary file and rename, so an interrupted job never leaves a partial table in the cache
+    out_path = os.path.join(cache_dir, f"{book}.npy")
+    tmp_path = os.path.join(cache_dir, f"{book}.tmp.npy")
+    np.save(tmp_path, table)
+    os.replace(tmp_path, out_path)
+    return book
+
+
+def build_ms_length_tables(path_dict, cache_dir, book_list=None, workers=None, overwrite=False, store_dir=None):
+    """Batch job to build the milestone length tables for a corpus across a pool of processes
+    path_dict: dict of book uri to the path of the OpenITI text (produced by create_path_dict)
+    cache_dir: directory to store the tables
+    book_list: only build tables for these books, if None build for every book in path_dict
+    workers: number of processes to use - defaults to the number of cpus
+    overwrite: if False, books that already have a table are skipped
+    store_dir: a store of pre-cleaned texts (see utilities.cleanedStore) - the tables of the books in the store are written
+    from the lengths it holds rather than by cleaning the OpenITI texts
+    Returns: an msLengthTable for the cache_dir"""
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    table = msLengthTable(cache_dir)
+
+    if book_list is None:
+        book_list = list(path_dict.keys())
+    to_build = [book for book in book_list if overwrite or book not in table]
+
+    # Books in the store are written here - only the milestone tables of the store are read
+    if store_dir:
+        store = cleanedCorpusStore(store_dir)
+        stored = [book for book in to_build if book in store]
+        print(f"Writing milestone length tables for {len(stored)} books from the store")
+        for book in tqdm(stored):
+            write_stored_ms_length_table(book, store, cache_dir)
+        to_build = [book for book in to_build if book not in store]
+
+    missing = [book for book in to_build if book not in path_dict]
+    if len(missing) > 0:
+        print(f"No OpenITI path for {len(missing)} books - skipping: {missing[:5]}")
+        to_build = [book for book in to_build if book in path_dict]
+
+    print(f"Building milestone length tables for {len(to_build)} books")
+    if len(to_build) > 0:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker_metrics, initargs=(get_metrics().enabled,)) as executor:
+            futures = [executor.submit(write_ms_length_table, book, path_dict[book], cache_dir) for book in to_build]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                future.result()
+
+    return table
+
+
+if __name__ == "__main__":
+    from find_shared_gaps.find_shared_gaps import create_path_dict
+    meta_path = "E:/Corpus Stats/2023/OpenITI_metadata_2023-1-8.csv"
+    openiti_base_dir = "E:/OpenITI Corpus/corpus_2023_1_8"
+    cache_dir = "E:/Corpus Stats/2023/ms_lengths"
+    build_ms_length_tables(create_path_dict(meta_path, openiti_base_dir), cache_dir)
@@ -1,26 +1,44 @@
 from openiti.helper.funcs import read_text, text_cleaner
+from collections import OrderedDict
+import mmap
 import re
 import os
 
 class openitiTextMs():
     """A class for handling an OpenITI text as a group of milestones and applying various functions to it"""
-    def __init__ (self, file_path, report=False):
+    def __init__ (self, file_path, report=False, lazy=False, use_mmap=False, clean_cache_size=256):
         """Read the text into the object using a file. Store the fulltext and store the milestone splits
         as a special type of dictionary:
         {22: "...كتابة..."}
-        On initiation, also create store maximum number of milestones in the text and the zfill level (for text mapping exercises)"""
+        On initiation, also create store maximum number of milestones in the text and the zfill level (for text mapping exercises)
+        lazy: instead of splitting the whole text, scan the file once for the byte offsets of the milestone markers and only
+        decode the milestones that are fetched. Use when only a few milestones of a long text are needed
+        use_mmap: in lazy mode, memory-map the file rather than reading it into memory
+        clean_cache_size: the number of cleaned milestones to keep in memory (least recently used are dropped first), so
+        a milestone that is fetched several times is only cleaned once. 0 turns the cache off, None keeps every milestone"""
         
         # Initiate the ms_pattern to be used across the class
         self.ms_pattern = r"ms\d+"
+        self.lazy = lazy
+
+        # Initiate the cache of cleaned milestones
+        self.clean_cache = OrderedDict()
+        self.clean_cache_size = clean_cache_size
+        self.clean_cache_hits = 0
+        self.clean_cache_misses = 0
 
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"File {file_path} does not exist")
 
-        # Read in OpenITI text - split off header        
-        self.mARkdown_text = read_text(file_path, remove_header=True)
-        
-        # Run the init pipeline that populates the ms_dict
-        self.init_process_milestones()
+        if lazy:
+            # Scan the raw file for the offsets of the milestones
+            self.init_ms_offsets(file_path, use_mmap=use_mmap)
+        else:
+            # Read in OpenITI text - split off header        
+            self.mARkdown_text = read_text(file_path, remove_header=True)
+            
+            # Run the init pipeline that populates the ms_dict
+            self.init_process_milestones()
 
         if report:
             self.report_stats()
@@ -102,14 +120,98 @@ class openitiTextMs():
         self.ms_dict = self.build_ms_dict(ms_splits)
         self.ms_total = len(self.ms_dict)
     
+    def find_body_start(self, buffer, header_splitter=b"#META#Header#End#"):
+        """Return the byte offset where the text body starts - matching the body returned by read_text(remove_header=True).
+        read_text measures the header after dropping a byte order mark but cuts the body from text that still has it, so when
+        the file starts with a BOM the body starts one character earlier (with the newline that ends the header)"""
+        splitter_start = buffer.find(header_splitter)
+        if splitter_start == -1:
+            return 0
+        line_end = buffer.find(b"\n", splitter_start)
+        body_start = len(buffer) if line_end == -1 else line_end + 1
+        if buffer[:3] == b"\xef\xbb\xbf":
+            body_start -= 1
+        return body_start
+
+    def init_ms_offsets(self, file_path, use_mmap=False):
+        """Lazy alternative to init_process_milestones - scan the file once and record the byte offsets of the text of each
+        milestone as a dictionary {22: (start, end)}. The text of a milestone runs from the end of the previous marker (or the
+        start of the body) to the start of its own marker - the same text that build_ms_dict stores. Note that only ascii digits
+        are recognised in the markers"""
+        with open(file_path, "rb") as f:
+            if use_mmap:
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.buffer = f.read()
+        
+        body_start = self.find_body_start(self.buffer)
+        ms_offsets = {}
+        previous_end = body_start
+        zfill = None
+        for match in re.compile(rb"ms([0-9]+)").finditer(self.buffer, body_start):
+            start, end = match.span()
+            if zfill is None:
+                zfill = len(match.group(1))
+            ms_offsets[int(match.group(1))] = (previous_end, start)
+            previous_end = end
+        
+        if zfill is None:
+            print("ERROR: Text does not contain a valid milestone splitter")
+            exit()
+        self.zfill_len = zfill
+        self.ms_offsets = ms_offsets
+        self.ms_total = len(ms_offsets)
+
+    def list_milestones(self):
+        """Return a sorted list of the milestone numbers in the text"""
+        if self.lazy:
+            return sorted(self.ms_offsets.keys())
+        return sorted(self.ms_dict.keys())
+
+    def read_ms_text(self, number):
+        """Return the raw text of a milestone - from the ms_dict, or in lazy mode decoded from the file offsets (with newlines
+        normalised in the same way as reading the file in text mode)"""
+        if not self.lazy:
+            return self.ms_dict[number]
+        start, end = self.ms_offsets[number]
+        text = self.buffer[start:end].decode("utf-8")
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        return text
+
+    def close(self):
+        """Release the memory-map (if one is used)"""
+        if self.lazy and isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+    def fetch_clean_milestone(self, number):
+        """Return the cleaned text of a milestone, using the cache of cleaned milestones"""
+        if number in self.clean_cache:
+            self.clean_cache_hits += 1
+            self.clean_cache.move_to_end(number)
+            return self.clean_cache[number]
+        
+        self.clean_cache_misses += 1
+        text = text_cleaner(self.read_ms_text(number))
+        if self.clean_cache_size != 0:
+            self.clean_cache[number] = text
+            if self.clean_cache_size is not None and len(self.clean_cache) > self.clean_cache_size:
+                self.clean_cache.popitem(last=False)
+        return text
+
+    def clean_cache_info(self):
+        """Return the hit and miss counts and current size of the cleaned milestone cache"""
+        return {"hits": self.clean_cache_hits, "misses": self.clean_cache_misses,
+                "size": len(self.clean_cache), "max_size": self.clean_cache_size}
+
     def fetch_milestone(self, number, clean=False):
         """Use integer to fetch a milestone with that number from the dictionary. If clean, clean using the standard
         OpenITI function (same that is used for passim cleaning - so offsets match)"""
         if type(number) == str:
             number = int(number)
-        text = self.ms_dict[number]
         if clean:
-            text = text_cleaner(text)
+            return self.fetch_clean_milestone(number)
+        text = self.read_ms_text(number)
         return text
     
     def fetch_offset_clean(self, ms_number, start = 0, end = -1, padding=0, trim=0):
@@ -154,6 +256,40 @@ class openitiTextMs():
 
         return text
     
+    def fetch_range_clean(self, start_ms, start_ch, end_ms, end_ch, ms_joins=True, padding=0):
+        """Return the cleaned text from start_ch in start_ms to end_ch in end_ms, for any number of milestones. The cleaned
+        milestones in the range are joined (with the milestone markers if ms_joins, as in fetch_ms_list_clean) and a prefix
+        sum of their lengths turns both positions into offsets into the joined text, so the range is taken with one slice
+        padding expands the range to the nearest token, as in fetch_offset_clean"""
+        ms_numbers = range(start_ms, end_ms + 1)
+        parts = []
+        for ms_number in ms_numbers:
+            parts.append(self.fetch_milestone(ms_number, clean=True))
+            if ms_joins and ms_number != end_ms:
+                parts.append(f"ms{str(ms_number).zfill(self.zfill_len)}")
+        text = "".join(parts)
+
+        # The last milestone starts after every part before it
+        start = start_ch
+        end = sum(len(part) for part in parts[:-1]) + end_ch
+        text_len = len(text)
+
+        # If adding padding - find end or start of nearest token to offset - to avoid word splitting
+        if padding != 0:
+            end = end + padding
+            while end < text_len:
+                end += 1
+                if end == text_len or text[end] == " ":
+                    break
+            if start != 0:
+                start = max(start - padding, 0)
+                while start > 0:
+                    start -= 1
+                    if text[start] == " ":
+                        break
+
+        return text[start:end]
+
     def fetch_ms_list_clean(self, ms_list, start=0, end=-1, ms_joins=True, padding=0, trim=0):
         """Take a list of consecutive milestones and return a complete cleaned text according to offsets. start is the offset into the first milestone
         and end is the offset into the last milestone